@@ -0,0 +1,523 @@
+"""Asyncio client library for the Tic-Tac-Toe server.
+
+GameConnection wraps one connection to the server, turns each server line
+into a typed event and offers awaitable move() / chat() / quit() calls.
+Because it needs no thread per player, a single process can run many bot
+players side by side:
+
+    async def bot(name):
+        conn = GameConnection("localhost", 5500, name)
+        await conn.connect()
+        async for event in conn.events():
+            if isinstance(event, Turn) and conn.my_turn:
+                await conn.move(*random_move(conn.board))
+
+MuxConnection does the same for many games over one socket, using the
+server's MUX extension, and ThreadedConnection runs a GameConnection in a
+background thread for the interactive CLI and the GUI.
+
+Run this file directly to start a crowd of random bots:
+
+    python async_client.py <server_host> <server_port> <count> [--games N] [--mux N]
+"""
+
+import asyncio
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+from collections import namedtuple
+
+from game_session import JOIN_REJECTIONS, MAX_SEATS_PER_CONN, MOVE_REJECTIONS, board_finished
+
+# ---------- Events ----------
+
+Start = namedtuple("Start", "mark opponent")
+Board = namedtuple("Board", "cells")
+Turn = namedtuple("Turn", "mark")
+Stats = namedtuple("Stats", "wins losses draws")
+Result = namedtuple("Result", "outcome")
+Msg = namedtuple("Msg", "sender text")
+Raw = namedtuple("Raw", "line")
+
+
+class Info(namedtuple("Info", "text")):
+    __slots__ = ()
+
+    @property
+    def rejects_move(self):
+        """True when this INFO is the server refusing our last MOVE."""
+        return self.text.startswith(MOVE_REJECTIONS)
+
+    @property
+    def rejects_join(self):
+        """True when this INFO is the server refusing to start our game."""
+        return self.text.startswith(JOIN_REJECTIONS)
+
+
+def parse_event(line):
+    """Turn one server line into an event, or None for a blank line.
+
+    Lines that do not match the protocol come back as Raw so callers can
+    still show them.
+    """
+    line = line.strip()
+    if not line:
+        return None
+    parts = line.split(" ", 1)
+    cmd = parts[0]
+    rest = parts[1] if len(parts) > 1 else ""
+
+    if cmd == "BOARD" and len(rest) == 9:
+        return Board(rest)
+    if cmd == "TURN":
+        return Turn(rest)
+    if cmd == "INFO":
+        return Info(rest)
+    if cmd == "MSG":
+        sender, sep, text = rest.partition(": ")
+        if sep:
+            return Msg(sender, text)
+        return Msg("", rest)
+    if cmd == "START":
+        tokens = rest.split()
+        if len(tokens) >= 2:
+            return Start(tokens[0], " ".join(tokens[1:]))
+    if cmd == "STATS":
+        tokens = rest.split()
+        if len(tokens) == 3 and all(t.isdigit() for t in tokens):
+            return Stats(*(int(t) for t in tokens))
+    if cmd == "RESULT":
+        return Result(rest)
+    return Raw(line)
+
+
+def random_move(board):
+    """Pick a random empty cell on a 9-char board, as (row, col)."""
+    empty = [i for i, ch in enumerate(board) if ch == "-"]
+    idx = random.choice(empty)
+    return divmod(idx, 3)
+
+
+# ---------- Connection ----------
+
+class GameConnection:
+    """One player's connection to the server.
+
+    The connection keeps the state of the current game (mark, board, turn,
+    result) up to date as events are read. The server closes the socket when
+    a game ends; new_game() transparently reconnects with the same username,
+    so one GameConnection can be reused for any number of games.
+    """
+
+    def __init__(self, host, port, username):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.reader = None
+        self.writer = None
+        self.reset()
+
+    def reset(self):
+        """Forget the state of the previous game."""
+        self.mark = None
+        self.opponent = None
+        self.board = "-" * 9
+        self.turn = None
+        self.stats = None
+        self.result = None
+
+    @property
+    def connected(self):
+        return self.writer is not None and not self.writer.is_closing()
+
+    @property
+    def my_turn(self):
+        # The server still sends TURN after the final BOARD, so check the board too
+        return (
+            self.result is None
+            and self.mark is not None
+            and self.turn == self.mark
+            and not board_finished(self.board)
+        )
+
+    async def connect(self):
+        """Open the socket and register the username."""
+        self.reset()
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        await self.send(f"USER {self.username}")
+
+    async def new_game(self):
+        """Get ready for another game, reconnecting if the server hung up."""
+        if self.connected and self.result is None:
+            return
+        await self.close()
+        await self.connect()
+
+    async def close(self):
+        if self.writer is None:
+            return
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except OSError:
+            pass
+        self.writer = None
+        self.reader = None
+
+    async def send(self, *lines):
+        """Write one or more protocol lines in a single write."""
+        if not self.connected:
+            raise ConnectionError("not connected")
+        self.writer.write(("\n".join(lines) + "\n").encode("utf-8"))
+        await self.writer.drain()
+
+    async def move(self, row, col):
+        await self.send(f"MOVE {row} {col}")
+
+    async def chat(self, text):
+        await self.send(f"CHAT {text}")
+
+    async def quit(self):
+        try:
+            await self.send("QUIT")
+        finally:
+            await self.close()
+
+    async def next_event(self):
+        """Wait for the next event; None once the server closed the connection."""
+        while self.reader is not None:
+            try:
+                raw = await self.reader.readline()
+            except (OSError, ValueError):
+                raw = b""
+            if not raw:
+                await self.close()
+                return None
+            event = parse_event(raw.decode("utf-8"))
+            if event is None:
+                continue
+            self.apply(event)
+            return event
+        return None
+
+    async def events(self):
+        """Async iterator over events until the connection closes."""
+        while True:
+            event = await self.next_event()
+            if event is None:
+                return
+            yield event
+
+    def apply(self, event):
+        """Update the game state from one event."""
+        if isinstance(event, Start):
+            self.mark = event.mark
+            self.opponent = event.opponent
+            self.board = "-" * 9
+            self.turn = None
+            self.result = None
+        elif isinstance(event, Board):
+            self.board = event.cells
+        elif isinstance(event, Turn):
+            self.turn = event.mark
+        elif isinstance(event, Stats):
+            self.stats = event
+        elif isinstance(event, Result):
+            self.result = event.outcome
+
+
+# ---------- Multiplexed connections ----------
+
+class MuxConnection:
+    """One socket carrying many games, using the server's MUX extension.
+
+    Each game is a MuxGame from game(); it behaves like a GameConnection, so
+    play_game() and other bot code work with either:
+
+        mux = MuxConnection("localhost", 5500)
+        await mux.connect()
+        results = await asyncio.gather(
+            *(play_game(mux.game(f"bot{n}")) for n in range(100))
+        )
+    """
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.reader = None
+        self.writer = None
+        self.games = {}  # gid -> MuxGame
+        self.next_gid = 0
+        self.read_task = None
+
+    @property
+    def connected(self):
+        return self.writer is not None and not self.writer.is_closing()
+
+    async def connect(self):
+        """Open the socket and switch it to multiplexed mode."""
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        await self.send("MUX")
+        # Skip the welcome INFO lines until the server confirms MUX
+        while True:
+            raw = await self.reader.readline()
+            if not raw:
+                raise ConnectionError("server closed the connection during MUX handshake")
+            if raw.decode("utf-8").strip() == "MUX OK":
+                break
+        self.read_task = asyncio.ensure_future(self.read_loop())
+
+    def game(self, username, room=None):
+        """Create a new game slot on this connection for username."""
+        gid = str(self.next_gid)
+        self.next_gid += 1
+        game = MuxGame(self, gid, username, room)
+        self.games[gid] = game
+        return game
+
+    async def send(self, *lines):
+        if not self.connected:
+            raise ConnectionError("not connected")
+        self.writer.write(("\n".join(lines) + "\n").encode("utf-8"))
+        await self.writer.drain()
+
+    async def read_loop(self):
+        try:
+            while True:
+                raw = await self.reader.readline()
+                if not raw:
+                    break
+                parts = raw.decode("utf-8").strip().split(" ", 2)
+                if len(parts) < 3 or parts[0] != "G":
+                    continue
+                game = self.games.get(parts[1])
+                if game is not None:
+                    event = parse_event(parts[2])
+                    if event is not None:
+                        game.queue.put_nowait(event)
+        except (OSError, ValueError):
+            pass
+        finally:
+            # Wake every game so their event loops see the disconnect
+            for game in self.games.values():
+                game.queue.put_nowait(None)
+            if self.writer is not None:
+                self.writer.close()
+
+    async def close(self):
+        if self.writer is None:
+            return
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except OSError:
+            pass
+        if self.read_task is not None:
+            await self.read_task
+        self.writer = None
+        self.reader = None
+
+
+class MuxGame(GameConnection):
+    """One game slot on a MuxConnection, with the GameConnection interface."""
+
+    def __init__(self, mux, gid, username, room=None):
+        self.mux = mux
+        self.gid = gid
+        self.room = room
+        self.joined = False
+        self.queue = asyncio.Queue()
+        super().__init__(mux.host, mux.port, username)
+
+    @property
+    def connected(self):
+        return self.mux.connected and self.joined
+
+    async def connect(self):
+        """Join the lobby for a new game on the shared connection."""
+        self.reset()
+        line = f"JOIN {self.username}"
+        if self.room:
+            line += f" {self.room}"
+        self.joined = True
+        await self.send(line)
+
+    async def send(self, *lines):
+        if not self.mux.connected:
+            raise ConnectionError("not connected")
+        await self.mux.send(*(f"G {self.gid} {line}" for line in lines))
+
+    async def quit(self):
+        if self.connected and self.result is None:
+            await self.send("QUIT")
+        await self.close()
+
+    async def close(self):
+        # The shared socket stays open; this game slot is simply finished
+        self.joined = False
+
+    async def next_event(self):
+        if not self.joined:
+            return None
+        event = await self.queue.get()
+        if event is None:
+            self.joined = False
+            return None
+        if isinstance(event, Info) and event.rejects_join and self.mark is None:
+            # No game will start for this JOIN: finish like a lost connection
+            self.joined = False
+            return None
+        self.apply(event)
+        if isinstance(event, Result):
+            # The server frees the game id after RESULT
+            self.joined = False
+        return event
+
+
+# ---------- Threaded programs ----------
+
+class ThreadedConnection:
+    """A GameConnection for programs that are not asyncio, like the CLI and GUI.
+
+    The connection runs on an event loop in a background thread. Every event
+    is handed to on_event(event) on that thread, then None once the server
+    closes the connection. The other methods may be called from any thread:
+
+        conn = ThreadedConnection("localhost", 5500, "alice", events.put)
+        conn.connect()
+        conn.move(1, 1)
+    """
+
+    def __init__(self, host, port, username, on_event):
+        self.conn = GameConnection(host, port, username)
+        self.on_event = on_event
+        self.quitting = False
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, name="connection", daemon=True).start()
+
+    @property
+    def connected(self):
+        return self.conn.connected
+
+    def call(self, coro):
+        """Run coro on the connection's loop and wait for its result."""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def connect(self):
+        """Connect and register the username; raises OSError on failure."""
+        self.call(self.conn.connect())
+        asyncio.run_coroutine_threadsafe(self.read_events(), self.loop)
+
+    async def read_events(self):
+        async for event in self.conn.events():
+            self.on_event(event)
+        if not self.quitting:
+            self.on_event(None)
+
+    def send(self, *lines):
+        """Write lines to the server.
+
+        A lost connection is not an error here; on_event(None) reports it.
+        """
+        try:
+            self.call(self.conn.send(*lines))
+        except OSError:
+            pass
+
+    def move(self, row, col):
+        self.send(f"MOVE {row} {col}")
+
+    def chat(self, text):
+        self.send(f"CHAT {text}")
+
+    def quit(self):
+        """Leave the game and close the connection."""
+        self.quitting = True
+        try:
+            self.call(self.conn.quit())
+        except OSError:
+            pass
+
+
+# ---------- Bots ----------
+
+async def play_game(conn, choose_move=random_move):
+    """Play one game on conn, asking choose_move(board) for each of our moves.
+
+    Returns the outcome (WIN / LOSE / DRAW), or None if the connection was
+    lost before a result arrived.
+    """
+    await conn.new_game()
+    async for event in conn.events():
+        if isinstance(event, Result):
+            break
+        if (isinstance(event, Turn) or (isinstance(event, Info) and event.rejects_move)) and conn.my_turn:
+            await conn.move(*choose_move(conn.board))
+    return conn.result
+
+
+async def run_bots(host, port, count, games=1, choose_move=random_move, prefix="bot", per_conn=0):
+    """Run count bot players concurrently, each playing games games.
+
+    With per_conn > 0 the bots share multiplexed connections, per_conn bots
+    on each socket (at most MAX_SEATS_PER_CONN), instead of opening one
+    socket per bot.
+    """
+    per_conn = min(per_conn, MAX_SEATS_PER_CONN)
+    summary = {"bots": count, "games": 0, "WIN": 0, "LOSE": 0, "DRAW": 0, "errors": 0}
+    muxes = []
+    if per_conn > 0:
+        for _ in range((count + per_conn - 1) // per_conn):
+            mux = MuxConnection(host, port)
+            await mux.connect()
+            muxes.append(mux)
+
+    async def one_bot(n):
+        if muxes:
+            conn = muxes[n // per_conn].game(f"{prefix}{n}")
+        else:
+            conn = GameConnection(host, port, f"{prefix}{n}")
+        try:
+            for _ in range(games):
+                try:
+                    outcome = await play_game(conn, choose_move)
+                except OSError:
+                    outcome = None
+                summary["games"] += 1
+                if outcome in ("WIN", "LOSE", "DRAW"):
+                    summary[outcome] += 1
+                else:
+                    summary["errors"] += 1
+        finally:
+            await conn.close()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one_bot(n) for n in range(count)))
+    for mux in muxes:
+        await mux.close()
+    summary["seconds"] = round(time.perf_counter() - started, 6)
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run random bot players against a server.")
+    parser.add_argument("host")
+    parser.add_argument("port", type=int)
+    parser.add_argument("count", type=int)
+    parser.add_argument("--games", type=int, default=1, help="games per bot")
+    parser.add_argument("--mux", type=int, default=0, metavar="N",
+                        help=f"share multiplexed connections, N bots per socket (max {MAX_SEATS_PER_CONN})")
+    args = parser.parse_args()
+
+    summary = asyncio.run(
+        run_bots(args.host, args.port, args.count, args.games, per_conn=args.mux)
+    )
+    print(json.dumps(summary))
+    sys.exit(1 if summary["errors"] else 0)
+
+
+if __name__ == "__main__":
+    main()
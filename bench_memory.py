@@ -0,0 +1,230 @@
+"""Memory benchmark for the server's connection and game records.
+
+Runs the server's Hub in a child process, fills it with idle connections
+(handshake done, no game) and with games in progress (both players seated,
+X has moved), and reads the child's resident memory after each step.
+
+    python bench_memory.py --idle 100000 --games 50000 --budget-mb 256
+
+Every idle connection takes a file descriptor on both sides, so when the
+limit (ulimit -n) is too low for --idle, the benchmark opens as many as fit
+and projects the rest from the measured cost per connection. Games are
+multiplexed, SEATS_PER_CONN seats per connection, so they all fit. Kernel
+socket buffers are not part of the process's memory and are not counted.
+"""
+
+import argparse
+import json
+import os
+import selectors
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+SEATS_PER_CONN = 500  # game seats multiplexed over one connection
+CONNECT_BATCH = 500  # connections opened at once
+SPARE_FDS = 64  # descriptors left for everything else
+SETTLE = 1.0  # seconds to let the server catch up before measuring
+
+
+def raise_fd_limit():
+    """Raise the soft descriptor limit to the hard one; return the limit."""
+    if resource is None:
+        return 512
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard != resource.RLIM_INFINITY and soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        soft = hard
+    return soft
+
+
+def rss_bytes():
+    """Resident memory of this process."""
+    try:
+        with open("/proc/self/statm", encoding="ascii") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+# ---------- Server side (child process) ----------
+
+def serve():
+    # Imported here so server.log / stats.json land in the child's
+    # temporary working directory
+    import server
+
+    raise_fd_limit()
+    # Measures the records, so no game cap (connections come in through
+    # accept_loop below, which has no caps either)
+    hub = server.Hub(server.Admission(max_games=sys.maxsize))
+    hub.start()
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(4096)
+
+    def accept_loop():
+        while True:
+            sock, addr = listener.accept()
+            hub.add(sock, addr)
+
+    threading.Thread(target=accept_loop, daemon=True).start()
+    print(listener.getsockname()[1], flush=True)
+    # Answer "rss" queries until the parent closes stdin
+    for _ in sys.stdin:
+        print(rss_bytes(), flush=True)
+
+
+# ---------- Client side ----------
+
+class Server:
+    def __init__(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.proc = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), "--serve"],
+            cwd=self.dir.name, stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True,
+        )
+        self.port = int(self.proc.stdout.readline())
+
+    def rss(self):
+        time.sleep(SETTLE)
+        self.proc.stdin.write("rss\n")
+        self.proc.stdin.flush()
+        return int(self.proc.stdout.readline())
+
+    def close(self):
+        self.proc.stdin.close()
+        self.proc.wait()
+        self.dir.cleanup()
+
+
+def connect_many(port, count):
+    """Open count connections that have all said MUX."""
+    socks = []
+    for start in range(0, count, CONNECT_BATCH):
+        sel = selectors.DefaultSelector()
+        batch = []
+        for _ in range(min(CONNECT_BATCH, count - start)):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setblocking(False)
+            sock.connect_ex(("127.0.0.1", port))
+            sel.register(sock, selectors.EVENT_WRITE)
+            batch.append(sock)
+        waiting = len(batch)
+        while waiting:
+            ready = sel.select(10)
+            if not ready:
+                raise TimeoutError("server stopped accepting connections")
+            for key, _ in ready:
+                sel.unregister(key.fileobj)
+                waiting -= 1
+        sel.close()
+        for sock in batch:
+            sock.send(b"MUX\n")
+        socks.extend(batch)
+    return socks
+
+
+# Reads and throws away everything the server sends on the game
+# connections; idle is set once nothing has arrived for a while
+class Drain(threading.Thread):
+    def __init__(self, socks):
+        super().__init__(daemon=True)
+        self.sel = selectors.DefaultSelector()
+        for sock in socks:
+            self.sel.register(sock, selectors.EVENT_READ)
+        self.idle = threading.Event()
+
+    def run(self):
+        while True:
+            ready = self.sel.select(0.5)
+            if not ready:
+                self.idle.set()
+                continue
+            self.idle.clear()
+            for key, _ in ready:
+                try:
+                    if not key.fileobj.recv(1 << 16):
+                        self.sel.unregister(key.fileobj)
+                except BlockingIOError:
+                    pass
+
+    def wait(self):
+        time.sleep(1)
+        self.idle.wait()
+
+
+def start_games(socks, games):
+    """Seat two players per game on the same connection; X moves once."""
+    for c, sock in enumerate(socks):
+        lines = []
+        first = c * SEATS_PER_CONN // 2
+        for g in range(first, min(games, first + SEATS_PER_CONN // 2)):
+            # A room per connection, so its seats pair with each other in order
+            lines.append(f"G x{g} JOIN px{g} r{c}\nG o{g} JOIN po{g} r{c}\nG x{g} MOVE 1 1\n")
+        sock.setblocking(True)
+        sock.sendall("".join(lines).encode("ascii"))
+        sock.setblocking(False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Server memory per idle connection and per game.")
+    parser.add_argument("--idle", type=int, default=100_000, help="idle connections to reach")
+    parser.add_argument("--games", type=int, default=50_000, help="games in progress")
+    parser.add_argument("--budget-mb", type=float, default=256, help="RSS budget for --idle + --games")
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.serve:
+        serve()
+        return
+
+    limit = raise_fd_limit()
+    game_conns = -(-2 * args.games // SEATS_PER_CONN)
+    idle = max(0, min(args.idle, limit - game_conns - SPARE_FDS))
+
+    srv = Server()
+    try:
+        base = srv.rss()
+        started = time.perf_counter()
+        idle_socks = connect_many(srv.port, idle)
+        after_idle = srv.rss()
+
+        game_socks = connect_many(srv.port, game_conns)
+        drain = Drain(game_socks)
+        drain.start()
+        start_games(game_socks, args.games)
+        drain.wait()
+        after_games = srv.rss()
+        seconds = time.perf_counter() - started
+    finally:
+        srv.close()
+
+    per_idle = (after_idle - base) / idle if idle else 0
+    per_game = (after_games - after_idle) / args.games if args.games else 0
+    projected = base + per_idle * args.idle + per_game * args.games
+    mb = 1 << 20
+    print(json.dumps({
+        "idle_measured": idle,
+        "games_measured": args.games,
+        "base_mb": round(base / mb, 1),
+        "bytes_per_idle_connection": round(per_idle),
+        "bytes_per_game": round(per_game),
+        "projected_mb": round(projected / mb, 1),
+        "targets": {"idle": args.idle, "games": args.games},
+        "budget_mb": args.budget_mb,
+        "within_budget": projected <= args.budget_mb * mb,
+        "seconds": round(seconds, 1),
+    }))
+
+
+if __name__ == "__main__":
+    main()
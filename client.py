@@ -1,30 +1,20 @@
-import socket
 import threading
 import sys
+import asyncio
+import argparse
+import json
+import time
 
-# Send one line to server
-def send_line(sock, text):
-    try:
-        sock.sendall((text + "\n").encode("utf-8"))
-    except OSError:
-        pass
-
+from async_client import (
+    GameConnection, ThreadedConnection,
+    Start, Board, Turn, Stats, Result, Msg, Info,
+)
 
-# Receive one line from socket, return None if disconnected
-def recv_line(sock):
-    data = []
-    try:
-        while True:
-            ch = sock.recv(1)
-            if not ch:
-                return None
-            ch = ch.decode("utf-8")
-            if ch == "\n":
-                break
-            data.append(ch)
-    except OSError:
-        return None
-    return "".join(data)
+# Local copy of the game so moves can be shown before the server echoes them.
+# "board" is always the last board the server confirmed; "pending" is the cell
+# index of a move we already drew but the server has not answered yet.
+game_lock = threading.Lock()
+game = {"board": "-" * 9, "mark": None, "turn": None, "pending": None}
 
 
 # Print the 3x3 tic-tac-toe board
@@ -44,78 +34,289 @@ def print_board(board_state):
     print()
 
 
-# Thread keeps reading messages from server
-def reader_thread(sock):
-    while True:
-        line = recv_line(sock)
-        if line is None:
-            print("\n[Disconnected from server]")
-            try:
-                sock.close()
-            except OSError:
-                pass
-            # Exit entire program
-            sys.exit(0)
-        
-        line = line.strip()
-        if not line:
+# Board as it should look right now: confirmed board plus our pending move.
+# The pending mark is lowercase so it stands out until the server confirms it.
+def predicted_board():
+    board = game["board"]
+    idx = game["pending"]
+    if idx is None or not game["mark"]:
+        return board
+    return board[:idx] + game["mark"].lower() + board[idx + 1:]
+
+
+# Try to apply a move locally before sending it, return True if it was drawn
+def predict_move(row, col):
+    try:
+        r = int(row)
+        c = int(col)
+    except ValueError:
+        return False
+    if not (0 <= r <= 2 and 0 <= c <= 2):
+        return False
+    idx = r * 3 + c
+    with game_lock:
+        if game["pending"] is not None:
+            return False
+        # Only once START gave us a mark and it is that mark's turn
+        if game["mark"] not in ("X", "O") or game["mark"] != game["turn"]:
+            return False
+        if game["board"][idx] != "-":
+            return False
+        game["pending"] = idx
+        board = predicted_board()
+    print_board(board)
+    print(f"[Pending] move {r} {c} sent, waiting for server...")
+    return True
+
+
+# Show one event from the server; runs on the connection's thread, and
+# event is None once the server has closed the connection
+def handle_event(event):
+    if event is None:
+        print("\n[Disconnected from server]")
+        return
+
+    if isinstance(event, Board):
+        # Server board always wins, any pending move is now settled
+        with game_lock:
+            game["board"] = event.cells
+            game["pending"] = None
+        print_board(event.cells)
+    elif isinstance(event, Turn):
+        with game_lock:
+            game["turn"] = event.mark
+        print(f"[Turn] Current player: {event.mark}")
+    elif isinstance(event, Info):
+        rolled_back = None
+        with game_lock:
+            if game["pending"] is not None and event.rejects_move:
+                game["pending"] = None
+                rolled_back = game["board"]
+        print(f"[Info] {event.text}")
+        if rolled_back is not None:
+            print("[Pending] move rejected, board restored:")
+            print_board(rolled_back)
+    elif isinstance(event, Msg):
+        print(f"[Chat] {event.sender}: {event.text}" if event.sender else f"[Chat] {event.text}")
+    elif isinstance(event, Start):
+        with game_lock:
+            game.update(board="-" * 9, mark=event.mark, turn=None, pending=None)
+        print(f"[Game] You are {event.mark}. Opponent: {event.opponent}")
+    elif isinstance(event, Stats):
+        print(f"[Stats] Wins: {event.wins}, Losses: {event.losses}, Draws: {event.draws}")
+    elif isinstance(event, Result):
+        with game_lock:
+            game["pending"] = None
+            game["turn"] = None
+        print(f"[Result] {event.outcome}")
+    else:
+        # Unknown or raw
+        print(event.line)
+
+
+# ---------- Batch mode ----------
+#
+# python client.py --batch <host> <port> <username> [script] [--games N]
+#
+# The script (a file, or stdin when omitted or "-") holds one command per
+# line, the same ones the interactive prompt takes. A line "---" ends one
+# game's block; blocks are played in order over fresh connections and
+# cycled when --games asks for more games than the script has.
+#
+#   chat good luck
+#   move 1 1
+#   move 0 0
+#   ---
+#   move 2 2
+#
+# Chats are written as soon as possible. Moves are the candidate cells for
+# our turns: the server refuses moves made out of turn, so each TURN for our
+# mark flushes every queued chat plus the next move in one write. A move the
+# server rejects is skipped and the next one is tried; running out of moves
+# on our turn sends QUIT. Every finished game prints one JSON line, and a
+# summary line follows at the end.
+
+
+# Split a batch script into per-game lists of (command, argument) tuples
+def parse_script(text):
+    games = [[]]
+    for raw in text.splitlines():
+        line = raw.strip()
+        if not line or line.startswith("#"):
             continue
+        if line == "---":
+            games.append([])
+            continue
+        tokens = line.split(" ", 1)
+        cmd = tokens[0].lower()
+        arg = tokens[1].strip() if len(tokens) > 1 else ""
+        if cmd == "move":
+            args = arg.split()
+            if len(args) != 2:
+                raise ValueError(f"bad move line: {raw!r}")
+            games[-1].append(("MOVE", f"{args[0]} {args[1]}"))
+        elif cmd == "chat":
+            if not arg:
+                raise ValueError(f"bad chat line: {raw!r}")
+            games[-1].append(("CHAT", arg))
+        elif cmd == "quit":
+            games[-1].append(("QUIT", ""))
+        else:
+            raise ValueError(f"unknown command: {raw!r}")
+    return [g for g in games if g]
 
-        parts = line.split(" ", 1)
-        cmd = parts[0]
-        rest = parts[1] if len(parts) > 1 else ""
-
-        if cmd == "BOARD":
-            print_board(rest)
-        elif cmd == "TURN":
-            print(f"[Turn] Current player: {rest}")
-        elif cmd == "INFO":
-            print(f"[Info] {rest}")
-        elif cmd == "MSG":
-            print(f"[Chat] {rest}")
-        elif cmd == "START":
-            # e.g. START X opponentName
-            tokens = rest.split()
-            if len(tokens) >= 2:
-                my_mark = tokens[0]
-                opp = " ".join(tokens[1:])
-                print(f"[Game] You are {my_mark}. Opponent: {opp}")
-            else:
-                print(f"[Game] {rest}")
-        elif cmd == "STATS":
-            tokens = rest.split()
-            if len(tokens) == 3:
-                wins, losses, draws = tokens
-                print(f"[Stats] Wins: {wins}, Losses: {losses}, Draws: {draws}")
+
+# Play one scripted game on conn, return a result dict
+async def play_batch_game(conn, commands):
+    started = time.perf_counter()
+    result = {
+        "user": conn.username,
+        "mark": None,
+        "opponent": None,
+        "result": None,
+        "moves": 0,
+        "rejected": 0,
+        "chats": 0,
+    }
+    move_rtts = []
+
+    await conn.new_game()
+    todo = list(commands)
+    move_sent_at = None
+    quit_sent = False
+    async for event in conn.events():
+        my_turn = False
+        if isinstance(event, Start):
+            # Any chats before the first move go out as soon as the game
+            # starts; the lobby would drop them
+            out = []
+            while todo and todo[0][0] == "CHAT":
+                out.append(f"CHAT {todo.pop(0)[1]}")
+                result["chats"] += 1
+            if out:
+                await conn.send(*out)
+        elif isinstance(event, Board):
+            if move_sent_at is not None:
+                move_rtts.append(time.perf_counter() - move_sent_at)
+                move_sent_at = None
+        elif isinstance(event, Info) and move_sent_at is not None and event.rejects_move:
+            # Our move was refused, so it is still our turn
+            move_sent_at = None
+            result["rejected"] += 1
+            my_turn = True
+        elif isinstance(event, Turn):
+            my_turn = conn.my_turn
+        elif isinstance(event, Result):
+            break
+
+        if my_turn and move_sent_at is None:
+            out = []
+            while todo:
+                kind, arg = todo.pop(0)
+                if kind == "CHAT":
+                    out.append(f"CHAT {arg}")
+                    result["chats"] += 1
+                    continue
+                if kind == "MOVE":
+                    out.append(f"MOVE {arg}")
+                    result["moves"] += 1
+                    move_sent_at = time.perf_counter()
+                else:
+                    out.append("QUIT")
+                    quit_sent = True
+                break
             else:
-                print(f"[Stats] {rest}")
-        elif cmd == "RESULT":
-            print(f"[Result] {rest}")
+                out.append("QUIT")
+                quit_sent = True
+            await conn.send(*out)
+
+    result["mark"] = conn.mark
+    result["opponent"] = conn.opponent
+    # The server sends no RESULT to a player who quits; the game is a loss
+    result["result"] = conn.result or ("QUIT" if quit_sent else None)
+    result["seconds"] = round(time.perf_counter() - started, 6)
+    if move_rtts:
+        result["move_rtt_ms"] = round(1000 * sum(move_rtts) / len(move_rtts), 3)
+    return result
+
+
+# Run scripted games back to back on one reusable connection object
+async def run_batch(host, port, username, games, total, retries=20):
+    summary = {"games": 0, "WIN": 0, "LOSE": 0, "DRAW": 0, "QUIT": 0, "errors": 0}
+    conn = GameConnection(host, port, username)
+    started = time.perf_counter()
+    for n in range(total):
+        commands = games[n % len(games)]
+        for attempt in range(retries):
+            try:
+                result = await play_batch_game(conn, commands)
+                break
+            except OSError as e:
+                # Server may still be closing the previous game
+                result = {"user": username, "error": str(e)}
+                await conn.close()
+                await asyncio.sleep(0.05 * (attempt + 1))
+        result["game"] = n + 1
+        print(json.dumps(result), flush=True)
+        summary["games"] += 1
+        if result.get("result") in ("WIN", "LOSE", "DRAW", "QUIT"):
+            summary[result["result"]] += 1
         else:
-            # Unknown or raw
-            print(line)
+            summary["errors"] += 1
+    await conn.close()
+    elapsed = time.perf_counter() - started
+    summary["seconds"] = round(elapsed, 6)
+    summary["games_per_sec"] = round(summary["games"] / elapsed, 3) if elapsed else None
+    print(json.dumps({"summary": summary}), flush=True)
+    return summary
+
+
+def batch_main(argv):
+    parser = argparse.ArgumentParser(prog="client.py --batch")
+    parser.add_argument("host")
+    parser.add_argument("port", type=int)
+    parser.add_argument("username")
+    parser.add_argument("script", nargs="?", default="-")
+    parser.add_argument("--games", type=int, default=None,
+                        help="number of games to play (default: one per script block)")
+    args = parser.parse_args(argv)
+
+    if args.script == "-":
+        text = sys.stdin.read()
+    else:
+        with open(args.script, "r", encoding="utf-8") as f:
+            text = f.read()
+    try:
+        games = parse_script(text)
+    except ValueError as e:
+        print(f"Script error: {e}", file=sys.stderr)
+        return 2
+    if not games:
+        print("Script has no commands.", file=sys.stderr)
+        return 2
+
+    total = args.games if args.games is not None else len(games)
+    summary = asyncio.run(run_batch(args.host, args.port, args.username, games, total))
+    return 1 if summary["errors"] else 0
 
 
-# Connect, start reader thread, handle user input
+# Connect, print server events as they come, handle user input
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "--batch":
+        sys.exit(batch_main(sys.argv[2:]))
+
     if len(sys.argv) != 4:
         print("Usage: python client.py <server_host> <server_port> <username>")
+        print("       python client.py --batch <server_host> <server_port> <username> [script] [--games N]")
         return
 
     host = sys.argv[1]
     port = int(sys.argv[2])
     username = sys.argv[3]
 
-    # Create TCP socket and connect to server
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    sock.connect((host, port))
-
-    # Start reader thread
-    t = threading.Thread(target=reader_thread, args=(sock,), daemon=True)
-    t.start()
-
-    # Send username
-    send_line(sock, f"USER {username}")
+    # Connect and send the username; events are printed as they arrive
+    conn = ThreadedConnection(host, port, username, handle_event)
+    conn.connect()
 
     print("Type commands:")
     print("  move r c     -> make a move at row r, col c (0-2)")
@@ -128,6 +329,8 @@ def main():
             user_input = input("> ")
         except EOFError:
             break
+        if not conn.connected:
+            break
         user_input = user_input.strip()
         if not user_input:
             continue
@@ -144,23 +347,22 @@ def main():
             if len(args) != 2:
                 print("Usage: move row col")
                 continue
-            send_line(sock, f"MOVE {args[0]} {args[1]}")
+            # Draw the move right away if it is legal on our copy of the board;
+            # the server still decides and BOARD / INFO will confirm or undo it
+            predict_move(args[0], args[1])
+            conn.move(args[0], args[1])
         
         # CHAT command: send the rest of the line as message
         elif cmd == "chat":
             if len(tokens) < 2:
                 print("Usage: chat your message")
                 continue
-            send_line(sock, f"CHAT {tokens[1]}")
+            conn.chat(tokens[1])
         
-        # Tell server to quit, then close socket and exit
+        # Tell server to quit, then close the connection and exit
         elif cmd == "quit":
-            send_line(sock, "QUIT")
+            conn.quit()
             print("Quitting...")
-            try:
-                sock.close()
-            except OSError:
-                pass
             break
         else:
             print("Unknown command. Use move/chat/quit.")
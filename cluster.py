@@ -0,0 +1,74 @@
+"""Run a whole cluster on this machine, every part as its own process: the
+stats service, some game server nodes and the router in front of them.
+
+    python cluster.py --nodes 3
+
+Players connect to the router on port 5500, as to a single server. Node k
+(1, 2, ...) listens on 5500 + 10 * k with its admin port one above, and
+runs in cluster/node-<port>/ so its server.log and handover socket are its
+own. The stats service keeps stats.json in this directory, where
+dashboard.py finds it. Ctrl-C stops everything.
+"""
+
+import argparse
+import os
+import signal
+import subprocess
+import sys
+import time
+
+import router
+import stats_service
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+NODE_DIR = "cluster"
+STOP_TIMEOUT = 5  # seconds to wait for the processes after Ctrl-C
+
+
+def start(script, args, cwd="."):
+    return subprocess.Popen([sys.executable, os.path.join(HERE, script)] + args, cwd=cwd)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the stats service, game server nodes and the router.")
+    parser.add_argument("--nodes", type=int, default=2)
+    parser.add_argument("--port", type=int, default=router.PORT, help="router port")
+    parser.add_argument("--stats-port", type=int, default=stats_service.PORT)
+    args = parser.parse_args()
+
+    stats = f"127.0.0.1:{args.stats_port}"
+    procs = [start("stats_service.py", ["--port", str(args.stats_port)])]
+    time.sleep(0.5)
+    for k in range(1, args.nodes + 1):
+        port = args.port + 10 * k
+        cwd = os.path.join(NODE_DIR, f"node-{port}")
+        os.makedirs(cwd, exist_ok=True)
+        procs.append(start("server.py", [
+            "--port", str(port), "--admin-port", str(port + 1), "--stats", stats,
+        ], cwd))
+    procs.append(start("router.py", ["--port", str(args.port), "--stats", stats]))
+
+    # A node that dies is left out by the router after a few seconds; the
+    # rest keep going until Ctrl-C
+    running = set(procs)
+    try:
+        while running:
+            time.sleep(0.5)
+            for proc in [p for p in running if p.poll() is not None]:
+                print(f"{' '.join(proc.args[1:])} exited with {proc.returncode}")
+                running.discard(proc)
+    except KeyboardInterrupt:
+        pass
+    for proc in procs:
+        if proc.poll() is None:
+            proc.send_signal(signal.SIGINT)
+    deadline = time.monotonic() + STOP_TIMEOUT
+    for proc in procs:
+        try:
+            proc.wait(max(0, deadline - time.monotonic()))
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,9 @@
-from flask import Flask, render_template_string
+from flask import Flask, Response, request
+import gzip
+import hashlib
 import json
 import os
+import threading
 from datetime import datetime
 
 STATS_FILE = "stats.json"
@@ -18,13 +21,21 @@ def load_stats():
             return {}
     return {}
 
-def load_logs(max_lines=100):
-    # Load the latest server logs; return up to max_lines
+def load_logs(max_lines=100, tail_bytes=65536):
+    # Load the latest server logs; return up to max_lines.
+    # Only the end of the file is read, the log can grow without limit.
     if not os.path.exists(LOG_FILE):
         return []
     try:
-        with open(LOG_FILE, "r", encoding="utf-8") as f:
-            lines = f.readlines()
+        with open(LOG_FILE, "rb") as f:
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            f.seek(max(0, size - tail_bytes))
+            data = f.read()
+        lines = data.decode("utf-8", "replace").splitlines(keepends=True)
+        if size > tail_bytes:
+            # First line is probably cut in half
+            lines = lines[1:]
         return lines[-max_lines:]
     except Exception:
         return []
@@ -61,7 +72,7 @@ TEMPLATE = """
 </head>
 <body>
     <h1>Network Tic-Tac-Toe Dashboard</h1>
-    <p class="timestamp">Last refresh: {{ now }}</p>
+    <p class="timestamp">Data as of: {{ updated }}</p>
 
     <h2>Player Stats</h2>
     {% if stats %}
@@ -99,21 +110,86 @@ TEMPLATE = """
 </html>
 """
 
+# Compiled once; autoescaping is the same as render_template_string
+PAGE = app.jinja_env.from_string(TEMPLATE)
+
+# Rendered responses, rebuilt only when stats.json or server.log change
+cache_lock = threading.Lock()
+cache = {"version": None}
+
+
+def source_version():
+    # mtime + size of both source files; changes whenever the server writes
+    version = []
+    for path in (STATS_FILE, LOG_FILE):
+        try:
+            st = os.stat(path)
+            version.append((st.st_mtime_ns, st.st_size))
+        except OSError:
+            version.append(None)
+    return tuple(version)
+
+
+def build_cache(version):
+    stats = load_stats()
+    mtimes = [v[0] for v in version if v is not None]
+    updated = (
+        datetime.fromtimestamp(max(mtimes) / 1e9).strftime("%Y-%m-%d %H:%M:%S")
+        if mtimes else "never"
+    )
+    html = PAGE.render(stats=stats, logs=load_logs(), updated=updated).encode("utf-8")
+    data = json.dumps(stats, sort_keys=True).encode("utf-8")
+
+    entries = {}
+    for name, body, mimetype in (
+        ("html", html, "text/html; charset=utf-8"),
+        ("json", data, "application/json"),
+    ):
+        entries[name] = {
+            "body": body,
+            "gzip": gzip.compress(body, 6),
+            "etag": hashlib.sha1(body).hexdigest()[:16],
+            "mimetype": mimetype,
+        }
+    return {"version": version, **entries}
+
+
+def cached_entry(name):
+    version = source_version()
+    with cache_lock:
+        if cache["version"] != version:
+            cache.clear()
+            cache.update(build_cache(version))
+        return cache[name]
+
+
+def cached_response(name):
+    entry = cached_entry(name)
+    if request.if_none_match.contains(entry["etag"]):
+        resp = Response(status=304)
+    elif "gzip" in request.accept_encodings:
+        resp = Response(entry["gzip"], mimetype=entry["mimetype"])
+        resp.headers["Content-Encoding"] = "gzip"
+    else:
+        resp = Response(entry["body"], mimetype=entry["mimetype"])
+    resp.set_etag(entry["etag"])
+    resp.headers["Vary"] = "Accept-Encoding"
+    # Browsers may keep the page but must check the ETag on every poll
+    resp.headers["Cache-Control"] = "no-cache"
+    return resp
+
+
 @app.route("/")
 def index():
-    raw_stats = load_stats()
-    # Convert dict values into simple objects so template can access attributes
-    stats = {
-        name: type("S", (), s) for name, s in raw_stats.items()
-    }
-    logs = load_logs()
-    return render_template_string(
-        TEMPLATE,
-        stats=stats,
-        logs=logs,
-        now=datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-    )
+    return cached_response("html")
+
+
+@app.route("/stats.json")
+def stats_json():
+    return cached_response("json")
+
 
 if __name__ == "__main__":
     # Default address: http://127.0.0.1:5000
-    app.run(debug=True)
+    # Set DASHBOARD_DEBUG=1 for the Flask debugger and reloader
+    app.run(debug=os.environ.get("DASHBOARD_DEBUG") == "1", threaded=True)
@@ -0,0 +1,253 @@
+"""Tic-tac-toe game rules as a pure state machine.
+
+GameSession knows nothing about sockets, threads or the stats file. It is
+fed what a player sent and returns a list of events saying what should be
+sent to whom and when the game is over; the caller does the actual I/O.
+The hub in server.py runs every game through it, and anything else (tests,
+bots, simulators) can too.
+
+    session = GameSession("alice", "bob")
+    events = session.start()
+    events = session.handle("X", "MOVE 1 1")
+"""
+
+from collections import namedtuple
+
+# Send text (one protocol line, no newline) to the player holding mark `to`
+Send = namedtuple("Send", "to text")
+
+# The game has ended. winner / loser are names (for a draw: X then O);
+# reason is "win", "draw", "quit" or "disconnect".
+GameOver = namedtuple("GameOver", "winner loser draw reason")
+
+# Rows, columns and diagonals of the 3x3 board, as cell indexes
+LINES = (
+    (0, 1, 2),
+    (3, 4, 5),
+    (6, 7, 8),
+    (0, 3, 6),
+    (1, 4, 7),
+    (2, 5, 8),
+    (0, 4, 8),
+    (2, 4, 6),
+)
+
+
+# Check 3x3 board winner / draw / ongoing
+def check_winner(board):
+    # Board is list of 9 chars: 'X', 'O', or '-'
+    for a, b, c in LINES:
+        if board[a] != "-" and board[a] == board[b] == board[c]:
+            return board[a]
+    if "-" not in board:
+        return "DRAW"
+    return None
+
+
+# True if a board (9 chars or list) already has a winner or no empty cell
+def board_finished(board):
+    return check_winner(board) is not None
+
+
+# Why a MOVE is refused; the server sends these as "INFO <reason>"
+NOT_YOUR_TURN = "It's not your turn."
+MOVE_USAGE = "Usage: MOVE row col"
+NOT_INTEGERS = "Row and col must be integers 0-2"
+OFF_BOARD = "Row and col must be between 0 and 2"
+CELL_TAKEN = "That cell is already taken."
+# Not a rule: the server's flood limits dropped the move
+MOVE_THROTTLED = "Too many commands, move not made."
+
+# Every INFO text a MOVE can be answered with instead of a new board, so
+# clients can tell their move was not made
+MOVE_REJECTIONS = (NOT_YOUR_TURN, MOVE_USAGE, NOT_INTEGERS, OFF_BOARD, CELL_TAKEN, MOVE_THROTTLED)
+
+# Most games one MUX connection may hold at once
+MAX_SEATS_PER_CONN = 500
+
+# Why a JOIN (or USER) is refused, as "INFO <reason>". The first two are
+# prefixes: the server adds the limit or the retry time.
+SEATS_FULL = "Too many games on this connection"
+SERVER_BUSY = "Server busy"
+GID_IN_USE = "Game id already in use."
+
+# Every INFO text that means no game was started for the JOIN, so clients
+# stop waiting for one
+JOIN_REJECTIONS = (SEATS_FULL, SERVER_BUSY, GID_IN_USE)
+
+
+# Check a MOVE from the player holding `mark`. Returns (cell index, None)
+# for a legal move, or (None, reason) when the move has to be refused.
+def parse_move(board, mark, current_mark, arg_text):
+    # Wrong player tries to move
+    if mark != current_mark:
+        return None, NOT_YOUR_TURN
+
+    args = arg_text.split()
+    if len(args) != 2:
+        return None, MOVE_USAGE
+
+    # Parse row/col
+    try:
+        r = int(args[0])
+        c = int(args[1])
+    except ValueError:
+        return None, NOT_INTEGERS
+    if not (0 <= r <= 2 and 0 <= c <= 2):
+        return None, OFF_BOARD
+
+    idx = r * 3 + c
+    if board[idx] != "-":
+        return None, CELL_TAKEN
+    return idx, None
+
+
+# An empty board; sessions keep their board as a 9-char string
+EMPTY_BOARD = "-" * 9
+
+
+# Convert board list into 9-char string
+def board_to_string(board):
+    return "".join(board)
+
+
+def other(mark):
+    return "O" if mark == "X" else "X"
+
+
+class GameSession:
+    """One game between X and O, from START to RESULT.
+
+    Servers keep many thousands of these around, so a session is just
+    two names, the board as a 9-char string and whose turn it is.
+    """
+
+    __slots__ = ("x_name", "o_name", "board", "current_mark", "over")
+
+    def __init__(self, x_name, o_name):
+        self.x_name = x_name
+        self.o_name = o_name
+        self.board = EMPTY_BOARD
+        self.current_mark = "X"  # X moves first
+        self.over = False
+
+    def name(self, mark):
+        return self.x_name if mark == "X" else self.o_name
+
+    def start(self, x_stats=None, o_stats=None):
+        """Events that open the game; stats dicts add a STATS line each."""
+        events = [
+            Send("X", f"START X {self.o_name}"),
+            Send("O", f"START O {self.x_name}"),
+        ]
+        for mark, st in (("X", x_stats), ("O", o_stats)):
+            if st is not None:
+                events.append(Send(mark, f"STATS {st['wins']} {st['losses']} {st['draws']}"))
+        events += self.board_events()
+        events += self.both("INFO Game started! X goes first.")
+        events += self.turn_events()
+        return events
+
+    def handle(self, mark, line):
+        """Events caused by one line sent by the player holding mark."""
+        if self.over:
+            return []
+        line = line.strip()
+        if not line:
+            return []
+
+        parts = line.split(" ", 1)
+        cmd = parts[0].upper()
+        arg = parts[1] if len(parts) > 1 else ""
+
+        # CHAT: any time, any player
+        if cmd == "CHAT":
+            if not arg.strip():
+                return [Send(mark, "INFO Usage: CHAT your message")]
+            return self.both(f"MSG {self.name(mark)}: {arg}")
+
+        # QUIT: player gives up, opponent wins
+        if cmd == "QUIT":
+            return self.forfeit(mark, "quit", "INFO Opponent quit. You win by default.")
+
+        # MOVE: only for current player
+        if cmd == "MOVE":
+            return self.move(mark, arg)
+
+        # Unknown commands
+        return [Send(mark, "INFO Unknown command. Use MOVE or CHAT or QUIT.")]
+
+    def snapshot(self):
+        """Plain-data copy of a running game, see restore()."""
+        return {
+            "x": self.x_name,
+            "o": self.o_name,
+            "board": self.board,
+            "turn": self.current_mark,
+        }
+
+    @classmethod
+    def restore(cls, state):
+        """A session that carries on from a snapshot() of another one."""
+        session = cls(state["x"], state["o"])
+        session.board = state["board"]
+        session.current_mark = state["turn"]
+        return session
+
+    def disconnect(self, mark):
+        """Events when the player holding mark has gone away."""
+        if self.over:
+            return []
+        return self.forfeit(mark, "disconnect", "INFO Opponent disconnected. You win by default.")
+
+    # ---- helpers ----
+
+    def both(self, text):
+        return [Send("X", text), Send("O", text)]
+
+    def board_events(self):
+        return self.both(f"BOARD {self.board}") + self.both(f"TURN {self.current_mark}")
+
+    def turn_events(self):
+        waiting = other(self.current_mark)
+        return [
+            Send(self.current_mark, "INFO Your turn. Use: MOVE row col (0-2) or CHAT message"),
+            Send(waiting, "INFO Waiting for opponent..."),
+        ]
+
+    def forfeit(self, mark, reason, info):
+        self.over = True
+        opp = other(mark)
+        return [
+            Send(opp, info),
+            Send(opp, "RESULT WIN"),
+            GameOver(self.name(opp), self.name(mark), False, reason),
+        ]
+
+    def move(self, mark, arg):
+        idx, error = parse_move(self.board, mark, self.current_mark, arg)
+        if error:
+            return [Send(mark, f"INFO {error}")]
+
+        self.board = self.board[:idx] + mark + self.board[idx + 1:]
+        winner = check_winner(self.board)
+        self.current_mark = other(self.current_mark)
+
+        # Broadcast new board and whose turn is next
+        events = self.board_events()
+
+        if winner == "DRAW":
+            self.over = True
+            events += self.both("INFO Game is a draw.")
+            events += self.both("RESULT DRAW")
+            events.append(GameOver(self.x_name, self.o_name, True, "draw"))
+        elif winner in ("X", "O"):
+            self.over = True
+            loser = other(winner)
+            events += self.both(f"INFO Player {self.name(winner)} ({winner}) wins!")
+            events.append(Send(winner, "RESULT WIN"))
+            events.append(Send(loser, "RESULT LOSE"))
+            events.append(GameOver(self.name(winner), self.name(loser), False, "win"))
+        else:
+            events += self.turn_events()
+        return events
@@ -1,48 +1,22 @@
-import socket
-import threading
 import queue
 import tkinter as tk
 from tkinter import simpledialog, messagebox, scrolledtext
 
-# ---------- Network Utility Functions ----------
-
-def send_line(sock, text):
-    """Send a UTF-8 encoded line (ending with newline) to the server."""
-    try:
-        print(f"[DEBUG] send_line -> {text}")
-        sock.sendall((text + "\n").encode("utf-8"))
-    except OSError as e:
-        print(f"[ERROR] send_line failed: {e}")
-
-def recv_line(sock):
-    """Receive a newline-terminated UTF-8 string from the server, one byte at a time."""
-    data = []
-    try:
-        while True:
-            ch = sock.recv(1)
-            if not ch:
-                return None
-            ch = ch.decode("utf-8")
-            if ch == "\n":
-                break
-            data.append(ch)
-    except OSError:
-        return None
-    return "".join(data)
+from async_client import ThreadedConnection, Start, Board, Turn, Stats, Result, Msg, Info
 
 # ---------- GUI Client ----------
 
 class TicTacToeGUI:
-    def __init__(self, root, sock, username):
+    def __init__(self, root, conn, msg_queue, username):
         self.root = root
-        self.sock = sock
+        self.conn = conn
         self.username = username
 
         self.root.title(f"Tic-Tac-Toe - {username}")
         self.root.protocol("WM_DELETE_WINDOW", self.on_close)
 
-        # Queue used to pass messages from the network thread to the GUI thread
-        self.msg_queue = queue.Queue()
+        # Server events from the connection's thread; None once it closed
+        self.msg_queue = msg_queue
 
         # Game state
         self.board_state = ["-"] * 9
@@ -50,6 +24,9 @@ class TicTacToeGUI:
         self.opponent = "?"
         self.current_turn = "?"
 
+        # Cell index of a move drawn locally but not yet confirmed by the server
+        self.pending_idx = None
+
         # ---------- UI Layout ----------
         top_frame = tk.Frame(root)
         top_frame.pack(pady=5, fill="x")
@@ -109,28 +86,31 @@ class TicTacToeGUI:
         idx = r * 3 + c
         print(f"[DEBUG] cell clicked r={r}, c={c}, idx={idx}, val={self.board_state[idx]}")
 
-        # Ignore if the cell is not empty
-        if self.board_state[idx] != "-":
+        # Ignore if the cell is not empty or a move is still in flight
+        if self.board_state[idx] != "-" or self.pending_idx is not None:
             return
 
+        # Draw the move immediately when it is ours to make; the server's
+        # BOARD reply confirms it and a rejection INFO rolls it back
+        if self.my_mark in ("X", "O") and self.my_mark == self.current_turn:
+            self.pending_idx = idx
+            self.buttons[idx].config(text=self.my_mark, fg="gray")
+            self.status_label.config(text="Move sent, waiting for server...")
+
         # Send MOVE request; server will validate turn ownership
-        send_line(self.sock, f"MOVE {r} {c}")
+        self.conn.move(r, c)
 
     def on_send_chat(self, event=None):
         """Send chat text to the server."""
         text = self.chat_entry.get().strip()
         if not text:
             return
-        send_line(self.sock, f"CHAT {text}")
+        self.conn.chat(text)
         self.chat_entry.delete(0, tk.END)
 
     def on_close(self):
         """Gracefully close the connection and exit."""
-        try:
-            send_line(self.sock, "QUIT")
-            self.sock.close()
-        except OSError:
-            pass
+        self.conn.quit()
         self.root.destroy()
 
     # ---------- UI Update Utilities ----------
@@ -148,62 +128,72 @@ class TicTacToeGUI:
         if len(board_string) != 9:
             return
         self.board_state = list(board_string)
+        self.pending_idx = None
+        self.redraw_board()
+
+    def redraw_board(self):
+        """Redraw all buttons from the last board confirmed by the server."""
         for i, ch in enumerate(self.board_state):
             text = ch if ch != "-" else " "
-            self.buttons[i].config(text=text)
+            self.buttons[i].config(text=text, fg="black")
+
+    def rollback_pending_move(self):
+        """Undo a locally drawn move that the server refused."""
+        print(f"[DEBUG] rollback_pending_move idx={self.pending_idx}")
+        self.pending_idx = None
+        self.redraw_board()
+        self.status_label.config(text=f"Current turn: {self.current_turn}")
 
     # ---------- Incoming Message Processing (from network thread) ----------
 
     def process_queue(self):
-        """Process queued server messages in the GUI thread."""
+        """Process queued server events in the GUI thread."""
         try:
             while not self.msg_queue.empty():
-                cmd, rest = self.msg_queue.get()
-                print(f"[DEBUG] process_queue cmd={cmd}, rest={rest}")
+                event = self.msg_queue.get()
+                print(f"[DEBUG] process_queue event={event!r}")
 
-                if cmd == "BOARD":
-                    self.update_board(rest)
+                if isinstance(event, Board):
+                    self.update_board(event.cells)
 
-                elif cmd == "TURN":
-                    self.current_turn = rest
+                elif isinstance(event, Turn):
+                    self.current_turn = event.mark
                     self.status_label.config(text=f"Current turn: {self.current_turn}")
 
-                elif cmd == "INFO":
-                    self.append_chat(f"[Info] {rest}")
-                    self.info_label.config(text=rest)
-
-                elif cmd == "MSG":
-                    self.append_chat(f"[Chat] {rest}")
-
-                elif cmd == "START":
-                    tokens = rest.split()
-                    if len(tokens) >= 2:
-                        self.my_mark = tokens[0]
-                        self.opponent = " ".join(tokens[1:])
-                        self.append_chat(
-                            f"[Game] You are {self.my_mark}. Opponent: {self.opponent}"
-                        )
-                    else:
-                        self.append_chat(f"[Game] {rest}")
-
-                elif cmd == "STATS":
-                    tokens = rest.split()
-                    if len(tokens) == 3:
-                        wins, losses, draws = tokens
-                        self.append_chat(
-                            f"[Stats] Wins: {wins}, Losses: {losses}, Draws: {draws}"
-                        )
-
-                elif cmd == "RESULT":
-                    self.append_chat(f"[Result] {rest}")
-                    self.status_label.config(text=f"Game result: {rest}")
+                elif isinstance(event, Info):
+                    if self.pending_idx is not None and event.rejects_move:
+                        self.rollback_pending_move()
+                    self.append_chat(f"[Info] {event.text}")
+                    self.info_label.config(text=event.text)
 
-                elif cmd == "DISCONNECT":
+                elif isinstance(event, Msg):
+                    if event.sender:
+                        self.append_chat(f"[Chat] {event.sender}: {event.text}")
+                    else:
+                        self.append_chat(f"[Chat] {event.text}")
+
+                elif isinstance(event, Start):
+                    self.pending_idx = None
+                    self.my_mark = event.mark
+                    self.opponent = event.opponent
+                    self.append_chat(
+                        f"[Game] You are {self.my_mark}. Opponent: {self.opponent}"
+                    )
+
+                elif isinstance(event, Stats):
+                    self.append_chat(
+                        f"[Stats] Wins: {event.wins}, Losses: {event.losses}, Draws: {event.draws}"
+                    )
+
+                elif isinstance(event, Result):
+                    # The game is over: no more clicks are sent as moves
+                    self.pending_idx = None
+                    self.current_turn = None
+                    self.append_chat(f"[Result] {event.outcome}")
+                    self.status_label.config(text=f"Game result: {event.outcome}")
+
+                elif event is None:
                     messagebox.showinfo("Disconnected", "Disconnected from server.")
-                    try:
-                        self.sock.close()
-                    except OSError:
-                        pass
                     self.root.destroy()
                     return
 
@@ -213,31 +203,6 @@ class TicTacToeGUI:
         # Schedule next queue check after 100 ms
         self.root.after(100, self.process_queue)
 
-    # ---------- Message Handler Called by Network Thread ----------
-
-    def handle_server_line(self, line):
-        """Parse a raw server line and push it into the GUI queue."""
-        print(f"[DEBUG] handle_server_line raw={line!r}")
-        line = line.strip()
-        if not line:
-            return
-        parts = line.split(" ", 1)
-        cmd = parts[0]
-        rest = parts[1] if len(parts) > 1 else ""
-        # Put into queue for GUI thread to handle
-        self.msg_queue.put((cmd, rest))
-
-# ---------- Network Reader Thread ----------
-
-def reader_thread(sock, gui: TicTacToeGUI):
-    """Continuously read lines from server and deliver them to the GUI."""
-    while True:
-        line = recv_line(sock)
-        if line is None:
-            gui.msg_queue.put(("DISCONNECT", ""))
-            break
-        gui.handle_server_line(line)
-
 # ---------- main ----------
 
 def main():
@@ -255,20 +220,17 @@ def main():
         return
     username = sys.argv[3]
 
+    # The connection thread queues every server event for the GUI thread
+    msg_queue = queue.Queue()
+    conn = ThreadedConnection(host, port, username, msg_queue.put)
     try:
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.connect((host, port))
+        conn.connect()
     except OSError as e:
         print(f"Could not connect to server: {e}")
         return
 
     root = tk.Tk()
-    gui = TicTacToeGUI(root, sock, username)
-
-    send_line(sock, f"USER {username}")
-
-    t = threading.Thread(target=reader_thread, args=(sock, gui), daemon=True)
-    t.start()
+    TicTacToeGUI(root, conn, msg_queue, username)
 
     root.mainloop()
 
@@ -0,0 +1,86 @@
+"""Passing server state and open sockets to another process.
+
+Used by server.py for restarts without dropping anyone: the running server
+sends a JSON snapshot of its games plus the file descriptors of its
+listening sockets and client connections over a Unix socket, with
+SCM_RIGHTS. The receiving process gets the very same connections, with any
+unread data still waiting in the kernel.
+
+Wire format on the (stream) Unix socket:
+
+    "<json length> <fd count>\\n" <json bytes>
+    then the fds, at most FDS_PER_MESSAGE per message, each message
+    carrying a single "F" byte
+
+Needs a Unix system and Python 3.9+ (socket.send_fds / recv_fds).
+"""
+
+import base64
+import json
+import socket
+
+FDS_PER_MESSAGE = 200  # Linux accepts at most 253 fds per message
+
+
+def pack_bytes(data):
+    """bytes -> str, for putting buffers into the JSON snapshot."""
+    return base64.b64encode(bytes(data)).decode("ascii")
+
+
+def unpack_bytes(text):
+    return base64.b64decode(text)
+
+
+def send_state(sock, state, socks):
+    """Send the snapshot and the file descriptors of socks, in order."""
+    payload = json.dumps(state).encode("utf-8")
+    fds = [s.fileno() for s in socks]
+    sock.sendall(f"{len(payload)} {len(fds)}\n".encode("ascii") + payload)
+    for i in range(0, len(fds), FDS_PER_MESSAGE):
+        socket.send_fds(sock, [b"F"], fds[i:i + FDS_PER_MESSAGE])
+
+
+def recv_exact(sock, size):
+    # Plain recv with an exact size, so the fd messages are never read by it
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("Handoff connection closed early")
+        data += chunk
+    return bytes(data)
+
+
+def recv_state(sock):
+    """Receive what send_state() sent. Returns (state, sockets)."""
+    header = b""
+    while not header.endswith(b"\n"):
+        header += recv_exact(sock, 1)
+    size, count = (int(n) for n in header.split())
+    state = json.loads(recv_exact(sock, size))
+
+    fds = []
+    while len(fds) < count:
+        _, received, _, _ = socket.recv_fds(sock, 1, FDS_PER_MESSAGE)
+        if not received:
+            raise ConnectionError("Handoff connection closed before all sockets arrived")
+        fds.extend(received)
+    return state, [socket.socket(fileno=fd) for fd in fds]
+
+
+def send_line(sock, text):
+    sock.sendall((text + "\n").encode("utf-8"))
+
+
+def recv_line(sock):
+    """One short control line ("READY", "GO"); "" if the peer went away."""
+    data = b""
+    while not data.endswith(b"\n"):
+        try:
+            ch = sock.recv(1)
+        except OSError:
+            return ""
+        if not ch:
+            return ""
+        data += ch
+    return data.decode("utf-8").strip()
@@ -0,0 +1,188 @@
+"""On-demand profiling for the running server.
+
+Nothing is measured until start() is called (from SIGUSR1 or the admin
+port, see server.py). For the requested window a background thread samples
+the stacks of every thread, and the server's timed sections (commands, line
+parsing, stats saving, sending, logging) record how long they took. When
+the window ends a plain-text report is written to a file.
+
+While profiling is off, section() only checks one attribute and hands back
+a shared no-op context manager, so the hooks can stay in production code.
+"""
+
+import logging
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+SAMPLE_INTERVAL = 0.005  # seconds between stack samples
+TOP_FUNCTIONS = 40  # functions listed in the report
+
+
+class NullSection:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL_SECTION = NullSection()
+
+
+class Section:
+    def __init__(self, profiler, label):
+        self.profiler = profiler
+        self.label = label
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.record(self.label, time.perf_counter() - self.start)
+        return False
+
+
+class TimedHandler:
+    """Wraps a logging handler's handle() so log writes show up as a section."""
+
+    def __init__(self, profiler, handler):
+        self.profiler = profiler
+        self.handler = handler
+        self.original = handler.handle
+
+    def __call__(self, record):
+        with self.profiler.section("logging"):
+            return self.original(record)
+
+
+class Profiler:
+    def __init__(self):
+        self.active = False
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.sections = {}  # label -> [count, total seconds, max seconds]
+        self.self_samples = Counter()
+        self.total_samples = Counter()
+        self.sample_count = 0
+        self.started = None
+
+    def section(self, label, detail=None):
+        """Context manager timing one piece of work, e.g. section("cmd", "MOVE")."""
+        if not self.active:
+            return NULL_SECTION
+        if detail is not None:
+            label = f"{label}.{detail}"
+        return Section(self, label)
+
+    def record(self, label, elapsed):
+        with self.lock:
+            entry = self.sections.get(label)
+            if entry is None:
+                self.sections[label] = [1, elapsed, elapsed]
+            else:
+                entry[0] += 1
+                entry[1] += elapsed
+                if elapsed > entry[2]:
+                    entry[2] = elapsed
+
+    def start(self, seconds, path=None):
+        """Profile for `seconds` and write the report to path.
+
+        Returns the report path, or None if a profile is already running.
+        Do not call it from a signal handler: the interrupted code may hold
+        self.lock (see record()).
+        """
+        if self.active:
+            return None
+        with self.lock:
+            if self.active:
+                return None
+            self.reset()
+            self.started = time.time()
+            self.active = True
+        if path is None:
+            path = datetime.now().strftime("profile-%Y%m%d-%H%M%S.txt")
+        t = threading.Thread(target=self.run, args=(seconds, path), name="profiler", daemon=True)
+        t.start()
+        return path
+
+    def run(self, seconds, path):
+        handlers = [TimedHandler(self, h) for h in logging.getLogger().handlers]
+        for wrapper in handlers:
+            wrapper.handler.handle = wrapper
+        own = threading.get_ident()
+        deadline = time.monotonic() + seconds
+        try:
+            while time.monotonic() < deadline:
+                self.sample(own)
+                time.sleep(SAMPLE_INTERVAL)
+        finally:
+            self.active = False
+            for wrapper in handlers:
+                wrapper.handler.handle = wrapper.original
+        self.dump(path, seconds)
+        logging.info("Profile written to %s", path)
+
+    def sample(self, own):
+        frames = sys._current_frames()
+        with self.lock:
+            for ident, frame in frames.items():
+                if ident == own:
+                    continue
+                self.sample_count += 1
+                seen = set()
+                top = True
+                while frame is not None:
+                    code = frame.f_code
+                    key = (code.co_filename, code.co_firstlineno, code.co_name)
+                    if top:
+                        self.self_samples[key] += 1
+                        top = False
+                    if key not in seen:
+                        seen.add(key)
+                        self.total_samples[key] += 1
+                    frame = frame.f_back
+
+    def dump(self, path, seconds):
+        with self.lock:
+            sections = sorted(self.sections.items(), key=lambda kv: -kv[1][1])
+            top = self.self_samples.most_common(TOP_FUNCTIONS)
+            total = self.total_samples
+            samples = self.sample_count or 1
+
+        started = datetime.fromtimestamp(self.started).strftime("%Y-%m-%d %H:%M:%S")
+        lines = [
+            f"Profile started {started}, {seconds:g} s, "
+            f"{self.sample_count} thread samples every {SAMPLE_INTERVAL * 1000:g} ms",
+            "",
+            "Sections",
+            f"  {'label':<24} {'count':>8} {'total ms':>10} {'mean ms':>9} {'max ms':>9}",
+        ]
+        for label, (count, spent, worst) in sections:
+            lines.append(
+                f"  {label:<24} {count:>8} {spent * 1000:>10.2f} "
+                f"{spent * 1000 / count:>9.3f} {worst * 1000:>9.3f}"
+            )
+        lines += [
+            "",
+            "Functions by samples (idle threads waiting in select / accept show up too)",
+            f"  {'self %':>7} {'total %':>7}  function",
+        ]
+        for key, count in top:
+            filename, lineno, name = key
+            lines.append(
+                f"  {100 * count / samples:>7.2f} {100 * total[key] / samples:>7.2f}"
+                f"  {name} ({filename}:{lineno})"
+            )
+        with open(path, "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+
+
+# The one profiler the server uses
+profiler = Profiler()
@@ -0,0 +1,373 @@
+"""Match router: one address in front of several game servers.
+
+Clients connect to the router exactly as they would to a single server.
+The router greets them and takes the handshake itself. Players who say
+"USER name" are paired first come, first served, and each match goes to
+the node with the fewest games (then connections), as the nodes last
+reported to the stats service. The router connects both players to that
+node with "MATCH <room> <X|O> <name>" and from then on only relays their
+bytes. A "MUX" connection is relayed as a whole to the least loaded node.
+A node only sees its own games, so capacity grows with every node added.
+
+    python stats_service.py
+    python server.py --port 5510 --admin-port 5511 --stats 127.0.0.1:5600
+    python server.py --port 5520 --admin-port 5521 --stats 127.0.0.1:5600
+    python router.py --stats 127.0.0.1:5600
+
+Every node needs its own working directory (server.log, server.sock).
+cluster.py starts the whole set in one go.
+"""
+
+import argparse
+import errno
+import itertools
+import logging
+import os
+import selectors
+import socket
+import threading
+import time
+
+from stats_service import StatsClient, parse_addr
+
+HOST = "0.0.0.0"
+PORT = 5500
+STATS = "127.0.0.1:5600"
+LOG_FILE = "router.log"
+
+REFRESH_INTERVAL = 0.5  # seconds between asking the stats service for node loads
+MAX_LINE = 4096  # longest line accepted before a player is relayed
+MAX_OUTBUF = 1 << 20  # a side that lets this much pile up is dropped
+
+WELCOME = (
+    b"INFO Welcome to Network Tic-Tac-Toe!\n"
+    b"INFO Please enter your username using: USER your_name\n"
+)
+# The same greeting comes first from every node, but the client already got
+# it from the router
+NODE_WELCOME_LINES = WELCOME.splitlines(keepends=True)
+NO_NODE = b"INFO No game server available, try again later.\n"
+
+# A client is in the handshake, waiting for an opponent, or relayed; the
+# router's own connection to a node is connecting, then relayed
+HELLO, WAITING, CONNECTING, RELAY = "hello", "waiting", "connecting", "relay"
+
+
+# One socket: a client, or the router's connection to a node for one client
+class End:
+    __slots__ = ("sock", "addr", "state", "name", "inbuf", "outbuf", "peer", "partner", "skip", "closing")
+
+    def __init__(self, sock, addr, state):
+        self.sock = sock
+        self.addr = addr
+        self.state = state
+        self.name = None
+        self.inbuf = b""
+        self.outbuf = bytearray()
+        self.peer = None  # the other End, once relayed
+        self.partner = None  # the opponent's client End, for a matched client
+        self.skip = 0  # greeting lines from the node still to throw away
+        self.closing = False  # close once all output is written
+
+
+class Router:
+    def __init__(self, stats):
+        self.stats = stats
+        self.sel = selectors.DefaultSelector()
+        self.waiting = None  # client waiting for an opponent
+        self.nodes = []  # [games, conns, "host:port"] as last reported
+        self.nodes_lock = threading.Lock()
+        # Room names only have to be unique per node; the pid keeps those
+        # of several routers apart
+        self.rooms = itertools.count(1)
+        self.prefix = f"r{os.getpid()}-"
+
+    # Keeps self.nodes up to date (runs on its own thread)
+    def refresh(self):
+        while True:
+            nodes = self.stats.nodes()
+            if nodes is not None:
+                with self.nodes_lock:
+                    self.nodes = [[n["games"], n["conns"], n["node"]] for n in nodes]
+            time.sleep(REFRESH_INTERVAL)
+
+    # The least loaded node, counted busier by what it is about to get so a
+    # burst is spread out before the next report comes in
+    def pick_node(self, games, conns):
+        with self.nodes_lock:
+            if not self.nodes:
+                return None
+            node = min(self.nodes)
+            node[0] += games
+            node[1] += conns
+            return parse_addr(node[2])
+
+    def run(self, listener):
+        listener.setblocking(False)
+        self.sel.register(listener, selectors.EVENT_READ, None)
+        while True:
+            for key, mask in self.sel.select():
+                if key.data is None:
+                    self.accept(listener)
+                    continue
+                end = key.data
+                # Closed by now, along with another End earlier in this round
+                if end.sock.fileno() == -1:
+                    continue
+                if end.state == CONNECTING:
+                    # A failed connect shows up as readable too
+                    self.connected(end)
+                    continue
+                if mask & selectors.EVENT_READ:
+                    self.read(end)
+                if mask & selectors.EVENT_WRITE and end.sock.fileno() != -1:
+                    self.flush(end)
+
+    def accept(self, listener):
+        while True:
+            try:
+                sock, addr = listener.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                logging.error("accept failed: %s", e)
+                return
+            sock.setblocking(False)
+            end = End(sock, addr, HELLO)
+            self.sel.register(sock, selectors.EVENT_READ, end)
+            self.write(end, WELCOME)
+
+    # ---- output ----
+
+    def write(self, end, data):
+        end.outbuf += data
+        self.flush(end)
+
+    def flush(self, end):
+        if end.sock.fileno() == -1 or end.state == CONNECTING:
+            return
+        if len(end.outbuf) > MAX_OUTBUF:
+            logging.info("Connection %s is not reading, dropping it", end.addr)
+            self.close(end)
+            return
+        if end.outbuf:
+            try:
+                sent = end.sock.send(end.outbuf)
+                del end.outbuf[:sent]
+            except (BlockingIOError, InterruptedError):
+                pass
+            except OSError:
+                self.close(end)
+                return
+        if end.closing and not end.outbuf:
+            self.close(end)
+            return
+        events = selectors.EVENT_READ
+        if end.outbuf:
+            events |= selectors.EVENT_WRITE
+        self.sel.modify(end.sock, events, end)
+
+    def close_soon(self, end):
+        end.closing = True
+        self.flush(end)
+
+    # This side is gone; the other one follows once its output is written
+    def close(self, end):
+        if end.sock.fileno() == -1:
+            return
+        if self.waiting is end:
+            self.waiting = None
+        self.sel.unregister(end.sock)
+        end.sock.close()
+        peer = end.peer
+        if peer is not None and peer.sock.fileno() != -1:
+            if peer.state == CONNECTING:
+                self.close(peer)
+            else:
+                self.close_soon(peer)
+
+    # ---- input ----
+
+    def read(self, end):
+        try:
+            data = end.sock.recv(65536)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b""
+        if not data:
+            self.close(end)
+            return
+        if end.state in (RELAY, CONNECTING):
+            self.relay(end, data)
+            return
+        end.inbuf += data
+        while end.state in (HELLO, WAITING) and not end.closing:
+            i = end.inbuf.find(b"\n")
+            if i < 0:
+                break
+            line = end.inbuf[:i].decode("utf-8", "replace").strip()
+            end.inbuf = end.inbuf[i + 1:]
+            if end.state == HELLO:
+                self.hello(end, line)
+            else:
+                self.lobby_line(end, line)
+        if end.state != RELAY and len(end.inbuf) > MAX_LINE:
+            logging.info("Connection %s sent an oversized line", end.addr)
+            self.close(end)
+
+    def relay(self, end, data):
+        if end.skip:
+            # Drop the node's greeting; the client got the router's. A node
+            # over its connection cap sends only its busy line, so the first
+            # line that is not the greeting ends the skipping and goes
+            # through, to the opponent as well.
+            data = end.inbuf + data
+            while end.skip:
+                i = data.find(b"\n")
+                if i < 0:
+                    break
+                if data[:i + 1] != NODE_WELCOME_LINES[-end.skip]:
+                    end.skip = 0
+                    self.refused(end.peer, data[:i + 1])
+                    break
+                data = data[i + 1:]
+                end.skip -= 1
+            end.inbuf = data if end.skip else b""
+            if end.skip:
+                return
+        if data:
+            self.write(end.peer, data)
+
+    # "USER name" or "MUX", answered as a server would
+    def hello(self, end, line):
+        if not line:
+            return
+        parts = line.split(" ", 1)
+        cmd = parts[0].upper()
+        if cmd == "MUX" and len(parts) == 1:
+            node = self.pick_node(0, 1)
+            if node is None:
+                self.write(end, NO_NODE)
+                self.close_soon(end)
+                return
+            logging.info("Multiplexed connection %s goes to %s:%d", end.addr, *node)
+            self.link(end, node, "MUX")
+            return
+        if cmd == "USER" and len(parts) == 2:
+            name = parts[1].strip()
+            if not name:
+                self.write(end, b"INFO Username cannot be empty.\n")
+                return
+            end.name = name
+            opponent = self.waiting
+            if opponent is None:
+                self.waiting = end
+                end.state = WAITING
+                self.write(end, f"INFO Hi {name}, waiting for an opponent to join...\n".encode("utf-8"))
+                return
+            self.waiting = None
+            self.start_match(opponent, end)
+            return
+        self.write(end, b"INFO Please use: USER your_name\n")
+
+    # A line from the player waiting for an opponent; as on a server, only
+    # QUIT does anything
+    def lobby_line(self, end, line):
+        if not line:
+            return
+        if line.split(" ", 1)[0].upper() == "QUIT":
+            self.waiting = None
+            self.write(end, b"INFO Left the lobby.\n")
+            self.close_soon(end)
+        else:
+            self.write(end, b"INFO Waiting for an opponent...\n")
+
+    # ---- matches ----
+
+    def start_match(self, end_x, end_o):
+        node = self.pick_node(1, 2)
+        if node is None:
+            for end in (end_x, end_o):
+                self.write(end, NO_NODE)
+                self.close_soon(end)
+            return
+        room = f"{self.prefix}{next(self.rooms)}"
+        logging.info("Match %s: %s vs %s on %s:%d", room, end_x.name, end_o.name, *node)
+        end_x.partner, end_o.partner = end_o, end_x
+        self.link(end_x, node, f"MATCH {room} X {end_x.name}")
+        if not end_o.closing:
+            self.link(end_o, node, f"MATCH {room} O {end_o.name}")
+
+    # Connect the client to node, send it first_line and relay from then on
+    def link(self, client, node, first_line):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        upstream = End(sock, node, CONNECTING)
+        upstream.skip = len(NODE_WELCOME_LINES)
+        upstream.peer = client
+        client.peer = upstream
+        client.state = RELAY
+        # Whatever the client sent after its handshake goes right after it
+        upstream.outbuf += (first_line + "\n").encode("utf-8") + client.inbuf
+        client.inbuf = b""
+        err = sock.connect_ex(node)
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            logging.error("Could not connect to node %s:%d: %s", *node, os.strerror(err))
+            sock.close()
+            self.no_node(client)
+            return
+        self.sel.register(sock, selectors.EVENT_READ | selectors.EVENT_WRITE, upstream)
+
+    def connected(self, upstream):
+        err = upstream.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            logging.error("Could not connect to node %s:%d: %s", *upstream.addr, os.strerror(err))
+            self.no_node(upstream.peer)
+            self.close(upstream)
+            return
+        upstream.state = RELAY
+        self.flush(upstream)
+
+    # The client's node could not be reached. Its opponent, if any, would
+    # wait on the node for nothing, so it goes too.
+    def no_node(self, client):
+        for end in (client, client.partner):
+            if end is not None and end.sock.fileno() != -1 and not end.closing:
+                self.write(end, NO_NODE)
+                self.close_soon(end)
+
+    # The client's node turned it away (line is its busy reply), and closes
+    # it. Its opponent, already sent to the same room, is told the same.
+    def refused(self, client, line):
+        partner = client.partner
+        if partner is not None and partner.sock.fileno() != -1 and not partner.closing:
+            self.write(partner, line)
+            self.close_soon(partner)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Route players to the least loaded game server.")
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--stats", default=STATS, metavar="HOST:PORT", help="stats service the nodes report to")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        filename=LOG_FILE,
+        level=logging.INFO,
+        format="%(asctime)s [%(levelname)s] %(message)s",
+    )
+    router = Router(StatsClient(parse_addr(args.stats)))
+    threading.Thread(target=router.refresh, name="refresh", daemon=True).start()
+
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((HOST, args.port))
+    listener.listen(128)
+    print(f"Router listening on {HOST}:{args.port}, nodes from stats service {args.stats}")
+    logging.info("Router starting on %s:%d", HOST, args.port)
+    router.run(listener)
+
+
+if __name__ == "__main__":
+    main()
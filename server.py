@@ -1,17 +1,81 @@
+import argparse
+import errno
 import socket
 import threading
 import json
 import os
 import logging
-import select
+import selectors
+import signal
+import subprocess
+import sys
+import time
+from collections import deque
+from functools import lru_cache
+
+try:
+    import fcntl
+except ImportError:  # Windows: saves are not locked against other processes
+    fcntl = None
+
+try:
+    import resource
+except ImportError:  # Windows: the connection cap is not checked against a limit
+    resource = None
+
+import handoff
+from game_session import (
+    GID_IN_USE, MAX_SEATS_PER_CONN, MOVE_THROTTLED, SEATS_FULL, SERVER_BUSY, GameSession, Send,
+)
+from profiler import profiler
+from stats_service import StatsClient, parse_addr
 
 # Server config
 HOST = "0.0.0.0"
 PORT = 5500
 
+# Admin commands (PROFILE ...) are only accepted on the loopback interface
+ADMIN_HOST = "127.0.0.1"
+ADMIN_PORT = 5501
+PROFILE_SECONDS = 30  # default profiling window
+
+# Restarts hand every connection to the new process over this Unix socket
+HANDOVER_SOCKET = "server.sock"
+HANDOVER_TIMEOUT = 10  # seconds to wait for the new process
+
+# Flood protection, per player: sustained rate (per second) and burst
+CHAT_RATE = 2.0
+CHAT_BURST = 5
+COMMAND_RATE = 20.0
+COMMAND_BURST = 40
+# ... and per connection, for every line before it reaches a seat: the
+# handshake, and all frames of a mux connection (JOIN, unknown game ids,
+# malformed frames included). A mux connection holds at most
+# MAX_SEATS_PER_CONN seats and may send as much as that many players.
+MUX_COMMAND_RATE = MAX_SEATS_PER_CONN * COMMAND_RATE
+MUX_COMMAND_BURST = MAX_SEATS_PER_CONN * COMMAND_BURST
+MAX_CHAT_LEN = 256  # longest chat message, in characters
+MAX_LINE = 1024  # longest line accepted from a plain player, in bytes
+CHAT_QUEUE_LEN = 32  # chat lines queued per recipient, oldest dropped first
+
+# Admission control: over a cap, new clients are told to come back later
+# instead of queueing. The defaults fit in the memory bench_memory.py
+# measured for 256 MB.
+BACKLOG = 128  # listen() backlog
+MAX_CONNS = 100_000  # open connections, at most the descriptor limit less FD_RESERVE
+FD_RESERVE = 32  # descriptors kept for listeners, logs, stats files and handovers
+ACCEPT_BACKOFF = 0.1  # seconds the accept thread waits when out of descriptors
+MAX_HANDSHAKES = 1_000  # connections that have not sent USER / MUX yet
+MAX_GAMES = 50_000  # games being played
+HANDSHAKE_TIMEOUT = 10  # seconds to send USER / MUX after connecting
+BUSY_RETRY = 5  # seconds clients are told to wait when the server is busy
+ACCEPT_PER_ROUND = 256  # new connections the hub takes on per round
+
 # Files for stats and logs
 STATS_FILE = "stats.json"
+STATS_LOCK_FILE = "stats.json.lock"  # locked while a process writes stats.json
 LOG_FILE = "server.log"
+STATS_SAVE_INTERVAL = 1.0  # seconds between writes of stats.json, when changed
 
 # Logging setup
 logging.basicConfig(
@@ -25,6 +89,18 @@ logging.basicConfig(
 stats_lock = threading.Lock()
 stats = {}
 
+# stats.json is written by a background thread, never by the hub. Other
+# processes (a tournament, another server) may share the file, so every
+# write merges this process's new results into what is on disk.
+stats_unsaved = []  # (winner, loser, draw) recorded here and not on disk yet
+stats_changed = threading.Event()  # set while there are results not on disk
+stats_save_lock = threading.Lock()  # one write of stats.json at a time
+stats_writer = None
+
+# When this server is one node of a cluster (--stats, see router.py) the
+# stats live in the stats service instead, and stats.json is not used
+stats_client = None
+
 
 # Load stats from json file if it exists
 def load_stats():
@@ -39,39 +115,124 @@ def load_stats():
         stats = {}
 
 
-# Save stats back to json file
+# Add (winner, loser, draw) results to a stats table
+def add_results(table, results):
+    for winner_name, loser_name, draw in results:
+        for name in [winner_name, loser_name]:
+            if name not in table:
+                table[name] = {"wins": 0, "losses": 0, "draws": 0}
+        if draw:
+            table[winner_name]["draws"] += 1
+            table[loser_name]["draws"] += 1
+        else:
+            table[winner_name]["wins"] += 1
+            table[loser_name]["losses"] += 1
+
+
+# Save new results to the json file: under a lock on STATS_LOCK_FILE, read
+# what is there, add ours and write a new file that is renamed into place,
+# so readers (the dashboard) never see half a file. What other processes
+# saved is taken over into memory as well.
 def save_stats():
-    with stats_lock:
+    global stats, stats_unsaved
+    with profiler.section("stats.save"), stats_save_lock:
+        # Results that come in from here on go into the next write
+        stats_changed.clear()
+        with stats_lock:
+            results, stats_unsaved = stats_unsaved, []
+            snapshot = {name: dict(st) for name, st in stats.items()}
         try:
-            with open(STATS_FILE, "w", encoding="utf-8") as f:
-                json.dump(stats, f, indent=2)
+            with open(STATS_LOCK_FILE, "a") as lock_file:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    with open(STATS_FILE, "r", encoding="utf-8") as f:
+                        data = json.load(f)
+                    add_results(data, results)
+                except FileNotFoundError:
+                    data = snapshot
+                except ValueError:
+                    logging.error("%s is damaged, writing it again from memory", STATS_FILE)
+                    data = snapshot
+                tmp = STATS_FILE + ".tmp"
+                with open(tmp, "w", encoding="utf-8") as f:
+                    json.dump(data, f, indent=2)
+                os.replace(tmp, STATS_FILE)
         except Exception as e:
             logging.error("Error saving stats: %s", e)
+            # Try again with the next write
+            with stats_lock:
+                stats_unsaved = results + stats_unsaved
+            stats_changed.set()
+            return
+        with stats_lock:
+            add_results(data, stats_unsaved)
+            stats = data
+
+
+# Write stats.json whenever results came in, at most once per
+# STATS_SAVE_INTERVAL, so that finishing a game never waits for the disk
+def write_stats_loop():
+    while True:
+        stats_changed.wait()
+        save_stats()
+        time.sleep(STATS_SAVE_INTERVAL)
+
+
+def start_stats_writer():
+    global stats_writer
+    with stats_save_lock:
+        if stats_writer is None:
+            stats_writer = threading.Thread(target=write_stats_loop, name="stats-writer", daemon=True)
+            stats_writer.start()
+
+
+# Write results that are not on disk yet, e.g. before exiting
+def flush_stats():
+    if stats_changed.is_set():
+        save_stats()
+    else:
+        # The writer may be in the middle of a write
+        with stats_save_lock:
+            pass
 
 
 # Update winner/loser stats or draw result
 def update_stats(winner_name, loser_name, draw=False):
+    update_stats_many([(winner_name, loser_name, draw)])
+
+
+# Record many finished games at once; stats.json is written shortly after
+# by the stats writer (see flush_stats). results: iterable of
+# (winner_name, loser_name, draw) tuples
+def update_stats_many(results):
+    if stats_client is not None:
+        # Queued and sent in the background
+        stats_client.results(results)
+        return
+    results = list(results)
     with stats_lock:
-        # Make sure both players have an entry
-        for name in [winner_name, loser_name]:
-            if name not in stats:
-                stats[name] = {"wins": 0, "losses": 0, "draws": 0}
-        
-        if draw:
-            stats[winner_name]["draws"] += 1
-            stats[loser_name]["draws"] += 1
-        else:
-            stats[winner_name]["wins"] += 1
-            stats[loser_name]["losses"] += 1
-    save_stats()
+        add_results(stats, results)
+        stats_unsaved.extend(results)
+    stats_changed.set()
+    if stats_writer is None:
+        start_stats_writer()
 
 
 # Get a single player's stats
 def get_stats(name):
+    return get_stats_many([name])[0]
+
+
+# Get several players' stats, with one request to the stats service
+def get_stats_many(names):
+    if stats_client is not None:
+        return stats_client.get(names)
     with stats_lock:
-        if name not in stats:
-            stats[name] = {"wins": 0, "losses": 0, "draws": 0}
-        return stats[name]
+        for name in names:
+            if name not in stats:
+                stats[name] = {"wins": 0, "losses": 0, "draws": 0}
+        return [stats[name] for name in names]
 
 
 # Send one line to a socket
@@ -100,302 +261,1197 @@ def recv_line(sock):
     return "".join(data)
 
 
-# Check 3x3 board winner / draw / ongoing
-def check_winner(board):
-    # Board is list of 9 chars: 'X', 'O', or '-'
-    lines = [
-        (0, 1, 2),
-        (3, 4, 5),
-        (6, 7, 8),
-        (0, 3, 6),
-        (1, 4, 7),
-        (2, 5, 8),
-        (0, 4, 8),
-        (2, 4, 6),
-    ]
-    for a, b, c in lines:
-        if board[a] != "-" and board[a] == board[b] == board[c]:
-            return board[a]
-    if "-" not in board:
-        return "DRAW"
-    return None
-
-
-# Convert board list into 9-char string
-def board_to_string(board):
-    return "".join(board)
-
+# ---------- Flood protection ----------
+
+# Marks a line that was longer than MAX_LINE and has been thrown away
+LINE_TOO_LONG = object()
+
+
+# Classic token bucket: `rate` tokens per second, at most `burst` saved up
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "stamp", "warned")
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+        self.warned = False
+
+    def take(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            self.warned = False
+            return True
+        return False
+
+    # Only tell the client once per burst of dropped lines
+    def warning(self, text):
+        if self.warned:
+            return None
+        self.warned = True
+        return text
+
+
+# Chat and command limits of one player
+class Limits:
+    __slots__ = ("chat", "commands")
+
+    def __init__(self):
+        self.chat = TokenBucket(CHAT_RATE, CHAT_BURST)
+        self.commands = TokenBucket(COMMAND_RATE, COMMAND_BURST)
+
+    # Returns (allowed, reply): reply is an INFO line to send back or None.
+    # A dropped MOVE is always answered, so the client knows it was not made.
+    def check(self, cmd, arg):
+        if not self.commands.take():
+            if cmd.upper() == "MOVE":
+                return False, f"INFO {MOVE_THROTTLED}"
+            return False, self.commands.warning("INFO Too many commands, slow down.")
+        if cmd.upper() == "CHAT":
+            if len(arg) > MAX_CHAT_LEN:
+                return False, f"INFO Chat message too long (max {MAX_CHAT_LEN} characters)."
+            if not self.chat.take():
+                return False, self.chat.warning("INFO Chat rate limit reached, message dropped.")
+        return True, None
+
+
+# Sort key so that moves run first, then other commands, then chat. JOIN
+# ranks with moves so a seat's JOIN still comes before its first MOVE.
+def command_priority(line):
+    if not isinstance(line, str):
+        return 1
+    cmd = line.lstrip().split(" ", 1)[0].upper()
+    if cmd in ("MOVE", "JOIN"):
+        return 0
+    if cmd == "CHAT":
+        return 2
+    return 1
+
+
+# Log games that ended without being played out
+def log_game_over(game_over):
+    if game_over.reason == "disconnect":
+        logging.info("Player %s disconnected, %s wins by default", game_over.loser, game_over.winner)
+    elif game_over.reason == "quit":
+        logging.info("Player %s quit, %s wins by default", game_over.loser, game_over.winner)
+
+
+# ---------- Admission control ----------
+
+# The caps on what the server takes on, and counts of what they turned
+# away. Connections over the connection or handshake cap are refused on
+# the accept thread, before the hub ever sees them; games over the game
+# cap are refused at JOIN / USER.
+class Admission:
+    def __init__(self, max_conns=MAX_CONNS, max_handshakes=MAX_HANDSHAKES, max_games=MAX_GAMES,
+                 handshake_timeout=HANDSHAKE_TIMEOUT, retry=BUSY_RETRY):
+        self.max_conns = max_conns
+        self.max_handshakes = max_handshakes
+        self.max_games = max_games
+        self.handshake_timeout = handshake_timeout
+        self.busy = f"INFO {SERVER_BUSY}, retry in {retry} s"
+        self.rejected_conns = 0
+        self.rejected_handshakes = 0
+        self.rejected_games = 0
+        self.handshake_timeouts = 0
+
+    # Called on the accept thread: True if a new connection may come in.
+    # Connections still queued for the hub count as handshakes.
+    def admit(self, hub):
+        # Under the hub's lock, so no socket is between the queue and the
+        # counts while they are added up
+        with hub.lock:
+            queued = len(hub.new_socks)
+            conns = hub.conns + queued
+            handshakes = hub.handshakes + queued
+        if conns >= self.max_conns:
+            self.rejected_conns += 1
+            return False
+        if handshakes >= self.max_handshakes:
+            self.rejected_handshakes += 1
+            return False
+        return True
+
+    # Tell a refused client to come back later, without blocking
+    def turn_away(self, sock):
+        try:
+            sock.setblocking(False)
+            sock.send((self.busy + "\n").encode("utf-8"))
+        except OSError:
+            pass
+        sock.close()
+
+    def status(self, hub):
+        return (
+            f"conns={hub.conns} handshakes={hub.handshakes} games={hub.games} "
+            f"queued={len(hub.new_socks)} rejected_conns={self.rejected_conns} "
+            f"rejected_handshakes={self.rejected_handshakes} rejected_games={self.rejected_games} "
+            f"handshake_timeouts={self.handshake_timeouts}"
+        )
+
+
+# ---------- Connections and games ----------
+#
+# Every connection, handshake, lobby and game lives in one Hub, run by a
+# single selector thread; there is no thread or blocking call per player.
+# A connection starts in the "hello" state and becomes either
+#
+#   plain   after "USER name": the classic protocol, one game per
+#           connection, closed by the server after RESULT. The router
+#           (router.py) says "MATCH <room> <X|O> name" instead, which
+#           pairs its two players with each other, with the marks given;
+#           only cluster nodes (--stats) take MATCH, and they listen on
+#           their --advertise address only, for the router
+#   mux     after "MUX": many games over one connection, every frame
+#           carries a game id chosen by the client (any token without
+#           spaces, unique per connection):
+#
+#   client -> server   G <gid> JOIN <username> [room]
+#                      G <gid> MOVE <row> <col>
+#                      G <gid> CHAT <message>
+#                      G <gid> QUIT
+#   server -> client   G <gid> <any normal server line>
+#
+# Plain players are paired with each other as they arrive. Mux seats that
+# JOIN the same room are paired first come, first served; after RESULT
+# the game id is free again. Closing a connection forfeits its games.
+#
+# The records are kept small so that very many idle connections and
+# games fit in memory: __slots__ everywhere, boards as 9-char strings,
+# interned names, buffers / chat queues / flood limits only allocated
+# while in use, and common lines encoded once and shared. See
+# bench_memory.py.
+
+HELLO, PLAIN, MUX = "hello", "plain", "mux"
+
+MUX_MAX_LINE = 4096  # longest line on a mux / hello connection
+TICK_INTERVAL = 1.0  # seconds between calls of Hub.tick
+MAX_OUTBUF = 1 << 20  # a client that lets this much pile up is dropped
+CHAT_BELOW = 16384  # queued chat is only written while outbuf is smaller
+
+
+# The line as bytes, newline included. Boards, turns and prompts repeat
+# all the time, so each is encoded once and shared by every connection.
+@lru_cache(maxsize=8192)
+def encode_line(text):
+    return (text + "\n").encode("utf-8")
+
+
+WELCOME = encode_line("INFO Welcome to Network Tic-Tac-Toe!") + encode_line(
+    "INFO Please enter your username using: USER your_name"
+)
 
-# Send current board + whose turn to both players
-def send_board(p1_sock, p2_sock, board, current_mark):
-    state = board_to_string(board)
-    for s in (p1_sock, p2_sock):
-        send_line(s, f"BOARD {state}")
-        send_line(s, f"TURN {current_mark}")
 
+# One client connection
+class Connection:
+    __slots__ = ("sock", "addr", "mode", "inbuf", "outbuf", "chat", "seats", "skipping", "closing", "bucket")
+
+    def __init__(self, sock, addr, mode=HELLO):
+        self.sock = sock
+        self.addr = addr
+        self.mode = mode
+        self.inbuf = b""
+        self.outbuf = None  # bytearray while there is output to write
+        self.chat = None  # deque of chat lines waiting for room
+        self.seats = None  # gid -> Seat; a plain connection has gid None
+        self.skipping = False  # inside an oversized plain line
+        self.closing = False  # close once all output is written
+        # Connection-wide TokenBucket for hello and mux lines, made on the
+        # first one; flood limits start afresh after a handover
+        self.bucket = None
+
+    def save(self):
+        return {
+            "addr": list(self.addr),
+            "mode": self.mode,
+            "inbuf": handoff.pack_bytes(self.inbuf),
+            "outbuf": handoff.pack_bytes(self.outbuf or b""),
+            "chat": list(self.chat or ()),
+            "skipping": self.skipping,
+            "closing": self.closing,
+        }
+
+    def load(self, saved):
+        self.inbuf = handoff.unpack_bytes(saved["inbuf"])
+        self.outbuf = bytearray(handoff.unpack_bytes(saved["outbuf"])) or None
+        if saved["chat"]:
+            self.chat = deque(saved["chat"], maxlen=CHAT_QUEUE_LEN)
+        self.skipping = saved["skipping"]
+        self.closing = saved["closing"]
+
+
+# One player in one game (or in the lobby)
+class Seat:
+    __slots__ = ("conn", "gid", "name", "room", "game", "mark", "limits")
+
+    def __init__(self, conn, gid, name, room):
+        self.conn = conn
+        self.gid = gid
+        self.name = name
+        self.room = room  # plain players from USER all wait in room ""
+        self.game = None
+        self.mark = None
+        # Each seat has its own flood limits, made on its first command
+        self.limits = None
+
+
+# A game between two seats
+class Game:
+    __slots__ = ("session", "x", "o")
+
+    def __init__(self, seat_x, seat_o, session=None):
+        self.session = session or GameSession(seat_x.name, seat_o.name)
+        self.x = seat_x
+        self.o = seat_o
+
+    def seat(self, mark):
+        return self.x if mark == "X" else self.o
+
+
+# Runs every connection and game in one selector loop
+class Hub:
+    def __init__(self, admission=None):
+        self.admission = admission or Admission()
+        self.sel = selectors.DefaultSelector()
+        self.lock = threading.Lock()
+        self.new_socks = []
+        self.calls = []  # functions other threads want run on the hub thread
+        self.lobby = {}  # room -> waiting mux Seat
+        self.waiting = {}  # room -> plain Seat waiting for an opponent
+        self.conns = 0  # open connections
+        self.handshakes = 0  # open connections still in "hello"
+        self.games = 0  # games being played, or paired and waiting for stats
+        self.deadlines = deque()  # (deadline, conn) of handshakes, oldest first
+        self.tick = None  # called with the hub every TICK_INTERVAL, on its thread
+        self.matches = False  # take "MATCH" from a router (cluster nodes only)
+        self.next_tick = 0.0
+        self.dirty = set()  # connections with queued output
+        self.incoming = []  # (priority, conn, line) read in this round
+        self.wake_r, self.wake_w = socket.socketpair()
+        self.wake_r.setblocking(False)
+        self.sel.register(self.wake_r, selectors.EVENT_READ, None)
+        self.freezing = threading.Event()
+        self.frozen = threading.Event()
+        self.saved = None
+
+    def start(self):
+        t = threading.Thread(target=self.run, name="hub", daemon=True)
+        t.start()
+        return t
+
+    # Hand over a newly accepted socket (called from other threads)
+    def add(self, sock, addr):
+        with self.lock:
+            self.new_socks.append((sock, addr))
+            first = len(self.new_socks) == 1
+        # One wakeup is enough for a whole batch of new sockets
+        if first:
+            try:
+                self.wake_w.send(b"x")
+            except OSError:
+                pass
+
+    # Run fn() on the hub thread in its next round (called from other threads)
+    def call_soon(self, fn):
+        with self.lock:
+            self.calls.append(fn)
+            first = len(self.calls) == 1
+        if first:
+            try:
+                self.wake_w.send(b"x")
+            except OSError:
+                pass
+
+    def run(self):
+        while True:
+            for key, mask in self.sel.select(TICK_INTERVAL):
+                if key.data is None:
+                    self.accept_new()
+                    continue
+                conn = key.data
+                if mask & selectors.EVENT_READ:
+                    self.read(conn)
+                if mask & selectors.EVENT_WRITE and conn.sock.fileno() != -1:
+                    self.dirty.add(conn)
+            # Moves first, then other commands, then chat
+            incoming, self.incoming = self.incoming, []
+            incoming.sort(key=lambda item: item[0])
+            for _, conn, line in incoming:
+                if conn.sock.fileno() != -1:
+                    self.handle_line(conn, line)
+            if self.calls:
+                with self.lock:
+                    calls, self.calls = self.calls, []
+                for fn in calls:
+                    fn()
+            self.expire_handshakes()
+            # Dropping a connection can queue output for others, so repeat
+            while self.dirty:
+                self.flush()
+            if self.tick is not None and time.monotonic() >= self.next_tick:
+                self.next_tick = time.monotonic() + TICK_INTERVAL
+                self.tick(self)
+            if self.freezing.is_set():
+                self.accept_new(None)
+                self.saved = self.save()
+                self.sel.close()
+                self.frozen.set()
+                return
 
-# Send INFO message to both players
-def send_info_to_both(p1_sock, p2_sock, msg):
-    for s in (p1_sock, p2_sock):
-        send_line(s, f"INFO {msg}")
+    # Take on at most `limit` new sockets, so that a burst of connections
+    # only delays running games by a bounded amount per round
+    def accept_new(self, limit=ACCEPT_PER_ROUND):
+        try:
+            self.wake_r.recv(4096)
+        except OSError:
+            pass
+        with self.lock:
+            new_socks = self.new_socks[:limit]
+            del self.new_socks[:len(new_socks)]
+            more = bool(self.new_socks)
+            # Counted as they leave the queue; see Admission.admit
+            self.conns += len(new_socks)
+            self.handshakes += len(new_socks)
+        if more:
+            self.wake_w.send(b"x")
+        deadline = time.monotonic() + self.admission.handshake_timeout
+        for sock, addr in new_socks:
+            sock.setblocking(False)
+            conn = Connection(sock, (sys.intern(addr[0]),) + tuple(addr[1:]))
+            self.sel.register(sock, selectors.EVENT_READ, conn)
+            self.deadlines.append((deadline, conn))
+            self.write(conn, WELCOME)
+
+    # Close connections that have not sent USER / MUX in time
+    def expire_handshakes(self):
+        now = time.monotonic()
+        while self.deadlines and self.deadlines[0][0] <= now:
+            _, conn = self.deadlines.popleft()
+            if conn.mode != HELLO or conn.closing or conn.sock.fileno() == -1:
+                continue
+            self.admission.handshake_timeouts += 1
+            self.write_line(
+                conn,
+                f"INFO No username received within {self.admission.handshake_timeout:g} s, closing connection.",
+            )
+            self.close_soon(conn)
+
+    # ---- output ----
+
+    def write(self, conn, data):
+        if conn.outbuf is None:
+            conn.outbuf = bytearray()
+        conn.outbuf += data
+        self.dirty.add(conn)
+
+    def write_line(self, conn, text):
+        self.write(conn, encode_line(text))
+
+    def send(self, seat, text):
+        conn = seat.conn
+        if text.startswith("MSG "):
+            # Chat waits in a bounded queue; when it is full the oldest goes
+            if conn.chat is None:
+                conn.chat = deque(maxlen=CHAT_QUEUE_LEN)
+            conn.chat.append(text if conn.mode == PLAIN else f"G {seat.gid} {text}")
+            self.dirty.add(conn)
+        elif conn.mode == MUX:
+            self.write(conn, f"G {seat.gid} ".encode("utf-8") + encode_line(text))
+        else:
+            self.write_line(conn, text)
 
+    # Close a connection as soon as its output has been written
+    def close_soon(self, conn):
+        conn.closing = True
+        self.dirty.add(conn)
 
-# Broadcast chat message from one player to both
-def broadcast_chat(p1_sock, p2_sock, sender_name, text):
-    line = f"MSG {sender_name}: {text}"
-    for s in (p1_sock, p2_sock):
-        send_line(s, line)
+    def flush(self):
+        dirty, self.dirty = self.dirty, set()
+        with profiler.section("send"):
+            for conn in dirty:
+                self.flush_one(conn)
 
+    def flush_one(self, conn):
+        if conn.sock.fileno() == -1:
+            return
+        out = conn.outbuf
+        if out is not None and len(out) > MAX_OUTBUF:
+            logging.info("Connection %s is not reading, dropping it", conn.addr)
+            self.drop(conn)
+            return
+        if conn.chat:
+            if out is None:
+                out = conn.outbuf = bytearray()
+            while conn.chat and len(out) < CHAT_BELOW:
+                out += (conn.chat.popleft() + "\n").encode("utf-8")
+        if out:
+            try:
+                sent = conn.sock.send(out)
+                del out[:sent]
+            except BlockingIOError:
+                pass
+            except OSError:
+                self.drop(conn)
+                return
+        # Give the buffers back while there is nothing to write
+        if not out:
+            conn.outbuf = None
+        if not conn.chat:
+            conn.chat = None
+        if conn.outbuf is None and conn.chat is None:
+            if conn.closing:
+                self.drop(conn)
+                return
+            events = selectors.EVENT_READ
+        else:
+            events = selectors.EVENT_READ | selectors.EVENT_WRITE
+        self.sel.modify(conn.sock, events, conn)
 
-# Handle a single tic-tac-toe game between two players
-def handle_game(p1_sock, p1_name, p2_sock, p2_name):
-    logging.info("Starting game between %s and %s", p1_name, p2_name)
+    # ---- input ----
 
-    # Player1 is X, player2 is O
-    p1_mark = "X"
-    p2_mark = "O"
+    def read(self, conn):
+        try:
+            data = conn.sock.recv(65536)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b""
+        if not data:
+            self.drop(conn)
+            return
+        buf = conn.inbuf + data
+        plain = conn.mode == PLAIN
+        with profiler.section("parse"):
+            while True:
+                i = buf.find(b"\n")
+                if i < 0:
+                    break
+                raw, buf = buf[:i], buf[i + 1:]
+                if conn.skipping:
+                    conn.skipping = False
+                    continue
+                if plain and len(raw) > MAX_LINE:
+                    self.incoming.append((1, conn, LINE_TOO_LONG))
+                    continue
+                line = raw.decode("utf-8", "replace").strip()
+                if conn.mode == HELLO:
+                    # Keep the handshake ahead of anything sent after it
+                    priority = 1
+                elif plain:
+                    priority = command_priority(line)
+                else:
+                    parts = line.split(" ", 2)
+                    priority = command_priority(parts[2] if len(parts) == 3 else line)
+                self.incoming.append((priority, conn, line))
+        if plain and len(buf) > MAX_LINE:
+            buf = b""
+            if not conn.skipping:
+                conn.skipping = True
+                self.incoming.append((1, conn, LINE_TOO_LONG))
+        elif len(buf) > MUX_MAX_LINE:
+            logging.info("Connection %s sent an oversized line", conn.addr)
+            self.drop(conn)
+            return
+        conn.inbuf = buf
+
+    # Connection-wide flood limit, checked before a hello or mux line is
+    # looked at; seats have their own limits on top
+    def allow_line(self, conn):
+        if conn.bucket is None:
+            if conn.mode == MUX:
+                conn.bucket = TokenBucket(MUX_COMMAND_RATE, MUX_COMMAND_BURST)
+            else:
+                conn.bucket = TokenBucket(COMMAND_RATE, COMMAND_BURST)
+        if conn.bucket.take():
+            return True
+        reply = conn.bucket.warning("INFO Too many commands, slow down.")
+        if reply:
+            self.write_line(conn, reply)
+        return False
+
+    def handle_line(self, conn, line):
+        if conn.mode == PLAIN:
+            self.plain_line(conn, line)
+        elif conn.mode == MUX:
+            self.mux_line(conn, line)
+        else:
+            self.hello(conn, line)
 
-    # Tell each player their mark and opponent name
-    send_line(p1_sock, f"START {p1_mark} {p2_name}")
-    send_line(p2_sock, f"START {p2_mark} {p1_name}")
+    # "USER name", "MATCH room mark name" or "MUX"
+    def hello(self, conn, line):
+        if not line or not self.allow_line(conn):
+            return
+        parts = line.split(" ", 1)
+        cmd = parts[0].upper()
+        if cmd == "MUX" and len(parts) == 1:
+            conn.mode = MUX
+            conn.bucket = None  # a mux connection gets a larger one
+            self.handshakes -= 1
+            logging.info("Multiplexed connection from %s", conn.addr)
+            self.write_line(conn, "MUX OK")
+            return
+        if cmd == "USER" and len(parts) == 2:
+            name = parts[1].strip()
+            if not name:
+                self.write_line(conn, "INFO Username cannot be empty.")
+                return
+            conn.mode = PLAIN
+            self.handshakes -= 1
+            self.join_plain(conn, sys.intern(name))
+            return
+        if cmd == "MATCH" and len(parts) == 2 and self.matches:
+            fields = parts[1].split(" ", 2)
+            if len(fields) == 3 and fields[1] in ("X", "O") and fields[2].strip():
+                conn.mode = PLAIN
+                self.handshakes -= 1
+                self.join_plain(conn, sys.intern(fields[2].strip()), fields[0], fields[1])
+                return
+        self.write_line(conn, "INFO Please use: USER your_name")
 
-    # Send stats to both players
-    stats1 = get_stats(p1_name)
-    stats2 = get_stats(p2_name)
-    send_line(p1_sock, f"STATS {stats1['wins']} {stats1['losses']} {stats1['draws']}")
-    send_line(p2_sock, f"STATS {stats2['wins']} {stats2['losses']} {stats2['draws']}")
+    def plain_line(self, conn, line):
+        seat = conn.seats.get(None) if conn.seats else None
+        if seat is None:
+            return
+        if line is LINE_TOO_LONG:
+            self.send(seat, f"INFO Line too long (max {MAX_LINE} bytes).")
+            return
+        if not line:
+            return
+        parts = line.split(" ", 1)
+        self.command(seat, parts[0].upper(), parts[1] if len(parts) > 1 else "")
 
-    # Init empty board
-    board = ["-"] * 9
-    current_mark = "X"  # X moves first
+    def mux_line(self, conn, line):
+        if not line:
+            return
+        parts = line.split(" ", 3)
+        if not self.allow_line(conn):
+            # As in Limits.check, a dropped move of a seat is always answered
+            if len(parts) >= 3 and parts[2].upper() == "MOVE" and conn.seats and parts[1] in conn.seats:
+                self.write_line(conn, f"G {parts[1]} INFO {MOVE_THROTTLED}")
+            return
+        if parts[0].upper() != "G" or len(parts) < 3:
+            self.write_line(conn, "INFO Use: G <game_id> JOIN|MOVE|CHAT|QUIT ...")
+            return
+        gid = parts[1]
+        cmd = parts[2].upper()
+        arg = parts[3] if len(parts) > 3 else ""
+        seat = conn.seats.get(gid) if conn.seats else None
+
+        if cmd == "JOIN":
+            with profiler.section("cmd", "JOIN"):
+                self.join(conn, gid, arg, seat)
+            return
+        if seat is None:
+            self.write_line(conn, f"G {gid} INFO Unknown game id. Use: G {gid} JOIN your_name")
+            return
+        self.command(seat, cmd, arg)
+
+    # One command from a seat, checked against its flood limits
+    def command(self, seat, cmd, arg):
+        if seat.limits is None:
+            seat.limits = Limits()
+        allowed, reply = seat.limits.check(cmd, arg)
+        if not allowed:
+            if reply:
+                self.send(seat, reply)
+            return
+        if seat.game is None:
+            # Still waiting in the lobby; only QUIT makes sense here
+            if cmd == "QUIT":
+                self.leave_lobby(seat)
+                self.send(seat, "INFO Left the lobby.")
+                if seat.conn.mode == PLAIN:
+                    self.close_soon(seat.conn)
+            else:
+                self.send(seat, "INFO Waiting for an opponent...")
+            return
 
-    # Broadcast initial board state
-    send_board(p1_sock, p2_sock, board, current_mark)
-    send_info_to_both(p1_sock, p2_sock, "Game started! X goes first.")
+        game = seat.game
+        with profiler.section("cmd", cmd):
+            self.play(game, game.session.handle(seat.mark, f"{cmd} {arg}"))
 
-    # Flag helps to only print "your turn" when turn actually changes
-    turn_just_changed = True
+    # ---- lobby and games ----
 
-    while True:
-        # Send turn info if needed
-        if turn_just_changed:
-            if current_mark == "X":
-                send_line(p1_sock, "INFO Your turn. Use: MOVE row col (0-2) or CHAT message")
-                send_line(p2_sock, "INFO Waiting for opponent...")
-            else:
-                send_line(p2_sock, "INFO Your turn. Use: MOVE row col (0-2) or CHAT message")
-                send_line(p1_sock, "INFO Waiting for opponent...")
-            turn_just_changed = False
+    # mark is given by the router only: the mark this player gets, and the
+    # router has already told them to wait
+    def join_plain(self, conn, name, room="", mark=None):
+        if self.games >= self.admission.max_games:
+            self.admission.rejected_games += 1
+            self.write_line(conn, self.admission.busy)
+            self.close_soon(conn)
+            return
+        seat = Seat(conn, None, name, room)
+        conn.seats = {None: seat}
+        opponent = self.waiting.pop(room, None)
+        if opponent is None:
+            self.waiting[room] = seat
+            if mark is None:
+                self.send(seat, f"INFO Hi {name}, waiting for an opponent to join...")
+            return
+        self.send(opponent, f"INFO Opponent {name} joined. Starting game...")
+        self.send(seat, f"INFO You are matched with {opponent.name}. Starting game...")
+        if mark == "X":
+            self.start_game(seat, opponent)
+        else:
+            self.start_game(opponent, seat)
 
-        # Wait for input from either player (move / chat / quit)
-        try:
-            readable, _, _ = select.select([p1_sock, p2_sock], [], [])
-        except Exception as e:
-            logging.error("select error: %s", e)
-            p1_sock.close()
-            p2_sock.close()
+    def join(self, conn, gid, arg, seat):
+        if seat is not None:
+            self.write_line(conn, f"G {gid} INFO {GID_IN_USE}")
+            return
+        tokens = arg.split()
+        if not tokens:
+            self.write_line(conn, f"G {gid} INFO Please use: G {gid} JOIN your_name [room]")
+            return
+        if conn.seats is not None and len(conn.seats) >= MAX_SEATS_PER_CONN:
+            self.write_line(conn, f"G {gid} INFO {SEATS_FULL} (max {MAX_SEATS_PER_CONN}).")
+            return
+        if self.games >= self.admission.max_games:
+            self.admission.rejected_games += 1
+            self.write_line(conn, f"G {gid} {self.admission.busy}")
+            return
+        name = sys.intern(tokens[0])
+        room = tokens[1] if len(tokens) > 1 else ""
+        seat = Seat(conn, gid, name, room)
+        if conn.seats is None:
+            conn.seats = {}
+        conn.seats[gid] = seat
+
+        waiting = self.lobby.pop(room, None)
+        if waiting is None:
+            self.lobby[room] = seat
+            self.send(seat, f"INFO Hi {name}, waiting for an opponent to join...")
+            return
+        self.start_game(waiting, seat)
+
+    def leave_lobby(self, seat):
+        lobby = self.waiting if seat.gid is None else self.lobby
+        if lobby.get(seat.room) is seat:
+            del lobby[seat.room]
+        seat.conn.seats.pop(seat.gid, None)
+
+    # The game counts from here, so the cap also covers pairs waiting for
+    # their stats; the stats service is never waited for on the hub thread
+    def start_game(self, seat_x, seat_o):
+        self.games += 1
+        names = [seat_x.name, seat_o.name]
+        if stats_client is None:
+            self.begin_game(seat_x, seat_o, get_stats_many(names))
+            return
+        stats_client.get_later(
+            names, lambda found: self.call_soon(lambda: self.begin_game(seat_x, seat_o, found))
+        )
+
+    def begin_game(self, seat_x, seat_o, found):
+        present = [seat for seat in (seat_x, seat_o) if self.seated(seat)]
+        if len(present) < 2:
+            # Someone left while the stats were looked up
+            self.games -= 1
+            for seat in present:
+                self.send(seat, "INFO Opponent left before the game started.")
+                self.requeue(seat)
+            return
+        logging.info("Starting game between %s and %s", seat_x.name, seat_o.name)
+        game = Game(seat_x, seat_o)
+        seat_x.game = seat_o.game = game
+        seat_x.mark, seat_o.mark = "X", "O"
+        self.play(game, game.session.start(*found))
+
+    def seated(self, seat):
+        conn = seat.conn
+        return conn.sock.fileno() != -1 and conn.seats is not None and conn.seats.get(seat.gid) is seat
+
+    # Back into the lobby of its room, or straight into a game with whoever
+    # is waiting there
+    def requeue(self, seat):
+        lobby = self.waiting if seat.gid is None else self.lobby
+        waiting = lobby.pop(seat.room, None)
+        if waiting is None:
+            lobby[seat.room] = seat
+            self.send(seat, "INFO Waiting for an opponent...")
             return
+        self.start_game(waiting, seat)
 
-        for s in readable:
-            # Map socket to player info
-            if s is p1_sock:
-                name, opp_name = p1_name, p2_name
-                mark = "X"
-                opp_sock = p2_sock
+    # Carry out the events a GameSession returned
+    def play(self, game, events):
+        for event in events:
+            if isinstance(event, Send):
+                self.send(game.seat(event.to), event.text)
+                continue
+            # GameOver: free both seats and record the result; plain
+            # connections are closed once RESULT has gone out
+            self.games -= 1
+            for seat in (game.x, game.o):
+                seat.game = None
+                seat.conn.seats.pop(seat.gid, None)
+                if seat.conn.mode == PLAIN:
+                    self.close_soon(seat.conn)
+            log_game_over(event)
+            update_stats(event.winner, event.loser, draw=event.draw)
+
+    def drop(self, conn):
+        if conn.sock.fileno() == -1:
+            return
+        if conn.mode == MUX:
+            logging.info("Multiplexed connection %s closed", conn.addr)
+        elif conn.mode == HELLO:
+            self.handshakes -= 1
+            print("Client", conn.addr, "disconnected before providing username.")
+        self.dirty.discard(conn)
+        try:
+            self.sel.unregister(conn.sock)
+        except (KeyError, ValueError):
+            pass
+        conn.sock.close()
+        self.conns -= 1
+        # Every game still running on this connection is lost by default
+        for seat in list((conn.seats or {}).values()):
+            if seat.game is None:
+                self.leave_lobby(seat)
+                continue
+            self.play(seat.game, seat.game.session.disconnect(seat.mark))
+
+    # ---- handing over to a new process ----
+
+    # Stop the hub after its current round and return (state, socks) for
+    # load(). Connections stay open. Called from another thread.
+    def freeze(self):
+        self.freezing.set()
+        self.wake_w.send(b"x")
+        self.frozen.wait()
+        return self.saved
+
+    def save(self):
+        conns = [key.data for key in self.sel.get_map().values() if key.data is not None]
+        state = {"conns": [], "seats": [], "games": []}
+        seat_ids = {}
+        for i, conn in enumerate(conns):
+            state["conns"].append(conn.save())
+            for seat in (conn.seats or {}).values():
+                seat_ids[seat] = len(state["seats"])
+                state["seats"].append({"conn": i, "gid": seat.gid, "name": seat.name, "room": seat.room})
+        # Seats without a game are the ones waiting in a lobby
+        games = {seat.game for seat in seat_ids if seat.game is not None}
+        for game in games:
+            state["games"].append({
+                "session": game.session.snapshot(),
+                "X": seat_ids[game.x],
+                "O": seat_ids[game.o],
+            })
+        return state, [conn.sock for conn in conns]
+
+    # Take over what save() returned, before start()
+    def load(self, state, socks):
+        conns = []
+        for saved, sock in zip(state["conns"], socks):
+            sock.setblocking(False)
+            conn = Connection(sock, tuple(saved["addr"]), saved["mode"])
+            conn.load(saved)
+            self.sel.register(sock, selectors.EVENT_READ, conn)
+            self.dirty.add(conn)
+            conns.append(conn)
+        # Handshakes get a fresh deadline in this process
+        deadline = time.monotonic() + self.admission.handshake_timeout
+        for conn in conns:
+            if conn.mode == HELLO:
+                self.handshakes += 1
+                self.deadlines.append((deadline, conn))
+        seats = []
+        for saved in state["seats"]:
+            conn = conns[saved["conn"]]
+            # Plain seats had room None before MATCH rooms existed
+            room = saved["room"] if saved["room"] is not None else ""
+            seat = Seat(conn, saved["gid"], sys.intern(saved["name"]), room)
+            if conn.seats is None:
+                conn.seats = {}
+            conn.seats[seat.gid] = seat
+            seats.append(seat)
+        for saved in state["games"]:
+            session = GameSession.restore(saved["session"])
+            game = Game(seats[saved["X"]], seats[saved["O"]], session)
+            game.x.game = game.o.game = game
+            game.x.mark, game.o.mark = "X", "O"
+        self.conns = len(conns)
+        self.games = len(state["games"])
+        # Two seats of one room were paired and waiting for their stats
+        for seat in seats:
+            if seat.game is not None:
+                continue
+            lobby = self.waiting if seat.gid is None else self.lobby
+            waiting = lobby.pop(seat.room, None)
+            if waiting is None:
+                lobby[seat.room] = seat
             else:
-                name, opp_name = p2_name, p1_name
-                mark = "O"
-                opp_sock = p1_sock
-
-            line = recv_line(s)
-            if line is None:
-                # If one player disconnects, the opponent wins by default
-                logging.info("Player %s disconnected, %s wins by default", name, opp_name)
-                send_line(opp_sock, "INFO Opponent disconnected. You win by default.")
-                send_line(opp_sock, "RESULT WIN")
-                update_stats(opp_name, name, draw=False)
-                p1_sock.close()
-                p2_sock.close()
-                return
+                self.start_game(waiting, seat)
+        # Get the first round going so queued output is written
+        self.wake_w.send(b"x")
+        return self.conns, self.games
+
+
+# ---------- Handing over to a new process ----------
+#
+# "python server.py --takeover" (started by hand, by the UPGRADE admin
+# command or by SIGHUP) connects to HANDOVER_SOCKET of the running server.
+# The old process stops accepting and freezes the hub between two rounds,
+# then sends a snapshot of all games, handshakes and lobbies together
+# with the listening and client sockets (see handoff.py). The new process
+# carries on from the snapshot; players only notice a short pause and no
+# game is ended or scored. Flood limits start afresh in the new process.
+#
+#   old -> new   snapshot + sockets
+#   new -> old   READY    (everything received)
+#   old -> new   GO       (old process exits, new one starts serving)
+#
+# If anything goes wrong before GO, the old process loads its own
+# snapshot into a fresh hub and keeps serving.
+
+# Hand everything to the new process on `channel` (run on the accept
+# thread, so nothing new comes in meanwhile). Returns (done, hub): done
+# is True once the new process has taken over; otherwise this process
+# carries on with a fresh hub.
+def hand_over(channel, listeners, hub):
+    started = time.perf_counter()
+    hub_state, hub_socks = hub.freeze()
+    # No game can end any more; the new process reads stats.json after GO
+    flush_stats()
+    state = {"listeners": len(listeners), "hub": hub_state}
+    socks = list(listeners) + hub_socks
 
-            line = line.strip()
-            if not line:
+    try:
+        channel.settimeout(HANDOVER_TIMEOUT)
+        handoff.send_state(channel, state, socks)
+        done = handoff.recv_line(channel) == "READY"
+        if done:
+            handoff.send_line(channel, "GO")
+    except OSError as e:
+        logging.error("Handover failed: %s", e)
+        done = False
+
+    if done:
+        logging.info(
+            "Handed over %d connections to the new process in %.1f ms",
+            len(hub_socks), (time.perf_counter() - started) * 1000,
+        )
+        return True, hub
+
+    logging.error("Handover called off: the new process did not take over")
+    old = hub
+    hub = Hub(old.admission)
+    hub.tick = old.tick
+    hub.matches = old.matches
+    hub.load(hub_state, hub_socks)
+    hub.start()
+    return False, hub
+
+
+# Take over from the server running in this directory. Returns the
+# listening sockets, the hub's snapshot and its sockets, or None if that
+# did not work out.
+def take_over():
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as channel:
+        channel.settimeout(HANDOVER_TIMEOUT)
+        try:
+            channel.connect(HANDOVER_SOCKET)
+            state, socks = handoff.recv_state(channel)
+        except (OSError, ValueError) as e:
+            print("Takeover failed:", e)
+            return None
+        handoff.send_line(channel, "READY")
+        if handoff.recv_line(channel) != "GO":
+            print("Takeover failed: the running server did not let go")
+            for sock in socks:
+                sock.close()
+            return None
+    count = state["listeners"]
+    return socks[:count], state["hub"], socks[count:]
+
+
+# Start a new server process that takes over from this one, with the
+# same options
+def start_successor():
+    options = [arg for arg in sys.argv[1:] if arg != "--takeover"]
+    args = [sys.executable, os.path.abspath(__file__)] + options + ["--takeover"]
+    proc = subprocess.Popen(args, cwd=os.getcwd())
+    logging.info("Started new server process %d to take over", proc.pid)
+    return proc.pid
+
+
+# Unix socket that a new server process connects to, to take over
+def open_handover_socket():
+    if not hasattr(socket, "AF_UNIX"):
+        return None
+    if os.path.exists(HANDOVER_SOCKET):
+        os.unlink(HANDOVER_SOCKET)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(HANDOVER_SOCKET)
+    sock.listen(1)
+    return sock
+
+
+# ---------- Admin commands ----------
+#
+# One command per connection on ADMIN_HOST:ADMIN_PORT, answered with one
+# line, e.g.  echo "PROFILE 30" | nc 127.0.0.1 5501
+#
+#   PROFILE [seconds]   sample the server for a while, write a report file
+#   STATUS              is a profile running? plus load, queue and
+#                       rejection counters (see Admission)
+#   UPGRADE             hand everything over to a freshly started server
+
+def start_profile(seconds):
+    path = profiler.start(seconds)
+    if path is None:
+        return "ERROR A profile is already running."
+    logging.info("Profiling for %s s, report goes to %s", seconds, path)
+    return f"OK Profiling for {seconds:g} s, report goes to {path}"
+
+
+def admin_command(line, hub):
+    parts = line.strip().split()
+    if not parts:
+        return "ERROR Empty command."
+    cmd = parts[0].upper()
+    if cmd == "PROFILE":
+        try:
+            seconds = float(parts[1]) if len(parts) > 1 else PROFILE_SECONDS
+        except ValueError:
+            return "ERROR Usage: PROFILE [seconds]"
+        if not 0 < seconds <= 3600:
+            return "ERROR Seconds must be between 0 and 3600."
+        return start_profile(seconds)
+    if cmd == "STATUS":
+        return f"OK profiling={'on' if profiler.active else 'off'} {hub.admission.status(hub)}"
+    if cmd == "UPGRADE":
+        if not hasattr(socket, "send_fds"):
+            return "ERROR Upgrades need a Unix system with Python 3.9+."
+        return f"OK Started new server process {start_successor()}, handing over."
+    return "ERROR Unknown command. Use PROFILE, STATUS or UPGRADE."
+
+
+def handle_admin(sock, hub):
+    with sock:
+        sock.settimeout(5)
+        line = recv_line(sock)
+        if line is not None:
+            send_line(sock, admin_command(line, hub))
+
+
+# kill -USR1 <pid> starts a profile with the default window. The handler
+# runs on the main thread between two bytecodes, possibly inside the
+# profiler's own lock, so the profile is started from another thread.
+def on_sigusr1(signum, frame):
+    threading.Thread(target=start_profile, args=(PROFILE_SECONDS,), name="sigusr1", daemon=True).start()
+
+
+# kill -HUP <pid> restarts the server without dropping anyone. Like
+# on_sigusr1, the handler may interrupt code holding a lock that logging
+# needs (the profiler's, when a profile wraps the log handlers), so the
+# new process is started from another thread.
+def on_sighup(signum, frame):
+    threading.Thread(target=start_successor, name="sighup", daemon=True).start()
+
+
+# Accept players, admin connections and handovers until this process has
+# handed over to a new one
+def serve(server_sock, admin_sock, handover_sock, hub):
+    sel = selectors.DefaultSelector()
+    sel.register(server_sock, selectors.EVENT_READ, "player")
+    sel.register(admin_sock, selectors.EVENT_READ, "admin")
+    if handover_sock is not None:
+        sel.register(handover_sock, selectors.EVENT_READ, "handover")
+
+    server_sock.setblocking(False)
+    while True:
+        for key, _ in sel.select():
+            if key.data == "player":
+                accept_players(server_sock, hub)
                 continue
-
-            parts = line.split(" ", 1)
-            cmd = parts[0].upper()
-
-            # CHAT: any time, any player
-            if cmd == "CHAT":
-                if len(parts) < 2 or not parts[1].strip():
-                    send_line(s, "INFO Usage: CHAT your message")
-                    continue
-                text = parts[1]
-                broadcast_chat(p1_sock, p2_sock, name, text)
+            try:
+                sock, addr = key.fileobj.accept()
+            except OSError:
                 continue
+            if key.data == "handover":
+                with sock:
+                    done, hub = hand_over(sock, (server_sock, admin_sock), hub)
+                if done:
+                    return
+            else:
+                threading.Thread(target=handle_admin, args=(sock, hub), daemon=True).start()
 
-            # QUIT: current player gives up, opponent wins
-            if cmd == "QUIT":
-                logging.info("Player %s quit, %s wins by default", name, opp_name)
-                send_line(opp_sock, "INFO Opponent quit. You win by default.")
-                send_line(opp_sock, "RESULT WIN")
-                update_stats(opp_name, name, draw=False)
-                p1_sock.close()
-                p2_sock.close()
-                return
-
-            # MOVE: only for current player
-            if cmd == "MOVE":
-                # Wrong player tries to move
-                if mark != current_mark:
-                    send_line(s, "INFO It's not your turn.")
-                    continue
-
-                if len(parts) < 2:
-                    send_line(s, "INFO Usage: MOVE row col")
-                    continue
-                args = parts[1].split()
-                if len(args) != 2:
-                    send_line(s, "INFO Usage: MOVE row col")
-                    continue
-
-                # Parse row/col
-                try:
-                    r = int(args[0])
-                    c = int(args[1])
-                except ValueError:
-                    send_line(s, "INFO Row and col must be integers 0-2")
-                    continue
-                if not (0 <= r <= 2 and 0 <= c <= 2):
-                    send_line(s, "INFO Row and col must be between 0 and 2")
-                    continue
-
-                idx = r * 3 + c
-                if board[idx] != "-":
-                    send_line(s, "INFO That cell is already taken.")
-                    continue
 
-                board[idx] = mark
+# Accept every player waiting in the backlog and pass them to the hub,
+# or turn them away at once when the server is over capacity
+def accept_players(server_sock, hub):
+    global fds_exhausted
+    admission = hub.admission
+    while True:
+        try:
+            sock, addr = server_sock.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            if e.errno in (errno.EMFILE, errno.ENFILE):
+                turn_away_without_fds(server_sock, admission)
+            else:
+                logging.error("accept failed: %s", e)
+            return
+        fds_exhausted = False
+        if not admission.admit(hub):
+            admission.turn_away(sock)
+            continue
+        print("Client connected from", addr)
+        logging.info("Client connected from %s", addr)
+        hub.add(sock, addr)
 
-                # Check result
-                winner = check_winner(board)
-                next_mark = "O" if current_mark == "X" else "X"
 
-                # Broadcast new board and whose turn is next
-                send_board(p1_sock, p2_sock, board, next_mark)
+# A descriptor held back for turn_away_without_fds, and whether running
+# out has been logged since the last accept that worked
+spare_fd = None
+fds_exhausted = False
 
-                # Handle win/draw
-                if winner == "DRAW":
-                    send_info_to_both(p1_sock, p2_sock, "Game is a draw.")
-                    send_line(p1_sock, "RESULT DRAW")
-                    send_line(p2_sock, "RESULT DRAW")
-                    update_stats(p1_name, p2_name, draw=True)
-                    p1_sock.close()
-                    p2_sock.close()
-                    return
-                elif winner == "X":
-                    msg = f"Player {p1_name} (X) wins!"
-                    send_info_to_both(p1_sock, p2_sock, msg)
-                    send_line(p1_sock, "RESULT WIN")
-                    send_line(p2_sock, "RESULT LOSE")
-                    update_stats(p1_name, p2_name, draw=False)
-                    p1_sock.close()
-                    p2_sock.close()
-                    return
-                elif winner == "O":
-                    msg = f"Player {p2_name} (O) wins!"
-                    send_info_to_both(p1_sock, p2_sock, msg)
-                    send_line(p2_sock, "RESULT WIN")
-                    send_line(p1_sock, "RESULT LOSE")
-                    update_stats(p2_name, p1_name, draw=False)
-                    p1_sock.close()
-                    p2_sock.close()
-                    return
 
-                # If no winner yet, switch turns and continue
-                current_mark = next_mark
-                turn_just_changed = True
+def reserve_spare_fd():
+    global spare_fd
+    if spare_fd is None:
+        try:
+            spare_fd = os.open(os.devnull, os.O_RDONLY)
+        except OSError:
+            pass
+
+
+# accept() failed for want of descriptors, and the listener stays
+# readable. Free the spare one to accept a single client and tell it the
+# server is busy; without a spare, wait a moment instead of spinning.
+def turn_away_without_fds(server_sock, admission):
+    global spare_fd, fds_exhausted
+    if not fds_exhausted:
+        fds_exhausted = True
+        logging.error("Out of file descriptors, turning new clients away")
+    if spare_fd is not None:
+        os.close(spare_fd)
+        spare_fd = None
+        try:
+            sock, _ = server_sock.accept()
+        except OSError:
+            sock = None
+        if sock is not None:
+            admission.rejected_conns += 1
+            admission.turn_away(sock)
+        reserve_spare_fd()
+    if spare_fd is None:
+        time.sleep(ACCEPT_BACKOFF)
+
+
+# Raise the soft descriptor limit to the hard one; returns the limit, or
+# None when there is none to go by
+def raise_fd_limit():
+    if resource is None:
+        return None
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+            soft = hard
+        except (ValueError, OSError):
+            pass
+    return None if soft == resource.RLIM_INFINITY else soft
 
-                break
 
-            # Unknown commands
-            send_line(s, "INFO Unknown command. Use MOVE or CHAT or QUIT.")
+# Tell the stats service how busy this node is, so the router can pick
+# the least loaded one (runs as the hub's tick)
+def load_reporter(advertise):
+    def report(hub):
+        stats_client.load(advertise, hub.conns, hub.games)
+    return report
 
 
 def main():
-    load_stats()
-    print(f"Server listening on {HOST}:{PORT}")
-    logging.info("Server starting on %s:%d", HOST, PORT)
-
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server_sock:
+    global stats_client
+    parser = argparse.ArgumentParser(description="Network Tic-Tac-Toe server.")
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--admin-port", type=int, default=ADMIN_PORT)
+    parser.add_argument("--stats", metavar="HOST:PORT",
+                        help="run as a cluster node, keeping stats in this stats service")
+    parser.add_argument("--advertise", metavar="HOST:PORT",
+                        help="address the router connects to (default 127.0.0.1:PORT)")
+    parser.add_argument("--takeover", action="store_true",
+                        help="take over from the server running in this directory")
+    parser.add_argument("--backlog", type=int, default=BACKLOG, help="listen() backlog")
+    parser.add_argument("--max-conns", type=int, default=MAX_CONNS)
+    parser.add_argument("--max-handshakes", type=int, default=MAX_HANDSHAKES)
+    parser.add_argument("--max-games", type=int, default=MAX_GAMES)
+    parser.add_argument("--handshake-timeout", type=float, default=HANDSHAKE_TIMEOUT,
+                        help="seconds a client has to send USER / MUX")
+    parser.add_argument("--busy-retry", type=int, default=BUSY_RETRY,
+                        help="retry hint, in seconds, sent to clients turned away")
+    args = parser.parse_args()
+
+    # Every connection is a descriptor: never admit more than there are
+    max_conns = args.max_conns
+    fd_limit = raise_fd_limit()
+    if fd_limit is not None and max_conns > fd_limit - FD_RESERVE:
+        max_conns = max(1, fd_limit - FD_RESERVE)
+        print(f"Connection cap lowered to {max_conns} (descriptor limit {fd_limit})")
+        logging.warning("Connection cap lowered to %d (descriptor limit %d)", max_conns, fd_limit)
+    reserve_spare_fd()
+    hub = Hub(Admission(
+        max_conns, args.max_handshakes, args.max_games, args.handshake_timeout, args.busy_retry,
+    ))
+
+    host = HOST
+    if args.stats:
+        stats_client = StatsClient(parse_addr(args.stats))
+        advertise = args.advertise or f"127.0.0.1:{args.port}"
+        hub.tick = load_reporter(advertise)
+        hub.matches = True
+        # MATCH lets a client pick its room and mark, so a node is only
+        # reachable where the router connects to it
+        host = parse_addr(advertise)[0]
+
+    if args.takeover:
+        taken = take_over()
+        if taken is None:
+            sys.exit(1)
+        (server_sock, admin_sock), state, socks = taken
+        # Only now: the old process saved its last results before GO
+        if stats_client is None:
+            load_stats()
+        conns, games = hub.load(state, socks)
+        print(f"Took over {conns} connections and {games} games on {host}:{args.port}")
+        logging.info("Took over %d connections and %d games", conns, games)
+    else:
+        if stats_client is None:
+            load_stats()
+        server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         server_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        server_sock.bind((HOST, PORT))
-        server_sock.listen(2)  # only one game at a time
-
-        # Accept player 1
-        p1_sock, p1_addr = server_sock.accept()
-        print("Player 1 connected from", p1_addr)
-        logging.info("Player 1 connected from %s", p1_addr)
-        send_line(p1_sock, "INFO Welcome to Network Tic-Tac-Toe!")
-        send_line(p1_sock, "INFO Please enter your username using: USER your_name")
+        server_sock.bind((host, args.port))
+        server_sock.listen(args.backlog)
+        admin_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        admin_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        admin_sock.bind((ADMIN_HOST, args.admin_port))
+        admin_sock.listen(4)
+        print(f"Server listening on {host}:{args.port}")
+        logging.info("Server starting on %s:%d", host, args.port)
+
+    hub.start()
+    handover_sock = open_handover_socket()
+
+    if hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, on_sigusr1)
+    if hasattr(signal, "SIGHUP") and handover_sock is not None:
+        signal.signal(signal.SIGHUP, on_sighup)
 
-        # Read username
-        while True:
-            line = recv_line(p1_sock)
-            if line is None:
-                print("Player 1 disconnected before providing username.")
-                p1_sock.close()
-                return
-            line = line.strip()
-            if not line:
-                continue
-            parts = line.split(" ", 1)
-            if parts[0].upper() == "USER" and len(parts) == 2:
-                p1_name = parts[1].strip()
-                if not p1_name:
-                    send_line(p1_sock, "INFO Username cannot be empty.")
-                    continue
-                break
-            else:
-                send_line(p1_sock, "INFO Please use: USER your_name")
-
-        send_line(p1_sock, f"INFO Hi {p1_name}, waiting for an opponent to join...")
-
-        # Accept player 2
-        p2_sock, p2_addr = server_sock.accept()
-        print("Player 2 connected from", p2_addr)
-        logging.info("Player 2 connected from %s", p2_addr)
-        send_line(p2_sock, "INFO Welcome to Network Tic-Tac-Toe!")
-        send_line(p2_sock, "INFO Please enter your username using: USER your_name")
-
-        # read username
-        while True:
-            line = recv_line(p2_sock)
-            if line is None:
-                print("Player 2 disconnected before providing username.")
-                p2_sock.close()
-                send_line(p1_sock, "INFO Opponent disconnected before game start.")
-                p1_sock.close()
-                return
-            line = line.strip()
-            if not line:
-                continue
-            parts = line.split(" ", 1)
-            if parts[0].upper() == "USER" and len(parts) == 2:
-                p2_name = parts[1].strip()
-                if not p2_name:
-                    send_line(p2_sock, "INFO Username cannot be empty.")
-                    continue
-                break
-            else:
-                send_line(p2_sock, "INFO Please use: USER your_name")
-
-        # Notify both players that the game is starting
-        send_line(p1_sock, f"INFO Opponent {p2_name} joined. Starting game...")
-        send_line(p2_sock, f"INFO You are matched with {p1_name}. Starting game...")
-
-        # Run the actual game loop
-        handle_game(p1_sock, p1_name, p2_sock, p2_name)
+    try:
+        serve(server_sock, admin_sock, handover_sock, hub)
+    finally:
+        flush_stats()
+        if stats_client is not None and not stats_client.flush():
+            logging.error("Exiting before the stats service confirmed every result")
+    print("Handed over to the new server process, exiting.")
 
 
 if __name__ == "__main__":
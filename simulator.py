@@ -0,0 +1,177 @@
+"""Batched tic-tac-toe self-play with NumPy.
+
+Instead of playing games one at a time, the simulator keeps a whole batch
+of boards in one (N, 9) int8 array (X = 1, O = -1, empty = 0) and advances
+every board by one move per step with a handful of array operations. A
+game never lasts more than nine steps, so a batch of a million games is
+finished in nine rounds. It is meant for random playouts and for measuring
+how bot policies do against each other; the rules match GameSession.
+
+    python simulator.py --games 10000000 --x greedy --o random
+
+Requires NumPy.
+"""
+
+import argparse
+import json
+import time
+
+import numpy as np
+
+from game_session import LINES
+
+X, O, EMPTY = 1, -1, 0
+
+# Tie-break preference of the greedy policy: centre, then corners, then edges
+CELL_PREFERENCE = np.array([2, 1, 2, 1, 4, 1, 2, 1, 2], dtype=np.float32)[:, None]
+
+
+def encode(board):
+    """Turn a 9-char board ('X' / 'O' / '-') into an int8 row."""
+    return np.array([{"X": X, "O": O}.get(ch, EMPTY) for ch in board], dtype=np.int8)
+
+
+def decode(row):
+    """Turn an int8 row back into a 9-char board."""
+    return "".join({X: "X", O: "O"}.get(int(v), "-") for v in row)
+
+
+# Inside the simulator a batch is stored cell-major: cells is a (9, N) array
+# whose row k holds cell k of every board. Every per-cell or per-line
+# operation is then a plain operation on contiguous length-N vectors.
+
+def winners(cells):
+    """Winner of every board: 1 for X, -1 for O, 0 for nobody (yet)."""
+    x_won = np.zeros(cells.shape[1], dtype=bool)
+    o_won = np.zeros(cells.shape[1], dtype=bool)
+    for a, b, c in LINES:
+        line = cells[a] + cells[b] + cells[c]
+        x_won |= line == 3
+        o_won |= line == -3
+    return x_won.astype(np.int8) - o_won.astype(np.int8)
+
+
+# ---------- Policies ----------
+#
+# A policy scores every cell of every board, as a (9, N) array; the move is
+# the highest scoring empty cell. marks holds the mark to move per board
+# (1 or -1), and keys is a (9, N) array of random numbers drawn once per
+# game: taking the empty cell with the highest key on every move gives a
+# uniformly random game without a fresh random draw each step.
+
+def random_scores(cells, marks, keys):
+    return keys
+
+
+def greedy_scores(cells, marks, keys):
+    # Win if possible, else block, else centre / corners / edges
+    scores = keys + CELL_PREFERENCE
+    empty = cells == EMPTY
+    for a, b, c in LINES:
+        line = cells[a] + cells[b] + cells[c]
+        # Two of the same mark in a line means its third cell is empty
+        bonus = np.where(line == 2 * marks, 100, np.where(line == -2 * marks, 50, 0))
+        for cell in (a, b, c):
+            scores[cell] += bonus * empty[cell]
+    return scores
+
+
+POLICIES = {
+    "random": random_scores,
+    "greedy": greedy_scores,
+}
+
+
+# ---------- Simulation ----------
+
+def playout(boards, marks, x_policy="random", o_policy="random", rng=None):
+    """Play every board in the batch to the end, in place.
+
+    boards: (N, 9) int8 array of positions, marks: (N,) mark to move on each.
+    Returns the (N,) outcomes: 1 X won, -1 O won, 0 draw.
+    """
+    rng = rng or np.random.default_rng()
+    cells = np.ascontiguousarray(boards.T)
+    marks = np.array(marks, dtype=np.int8)
+    n = cells.shape[1]
+    keys = rng.random(cells.shape, dtype=np.float32)
+
+    outcome = winners(cells)
+    empties = (cells == EMPTY).sum(axis=0)
+    active = (outcome == 0) & (empties > 0)
+
+    while active.any():
+        if x_policy == o_policy:
+            scores = POLICIES[x_policy](cells, marks, keys)
+        else:
+            scores = np.where(
+                marks == X,
+                POLICIES[x_policy](cells, marks, keys),
+                POLICIES[o_policy](cells, marks, keys),
+            )
+
+        # Highest scoring empty cell of every board
+        best = np.full(n, -np.inf, dtype=np.float32)
+        move = np.zeros(n, dtype=np.int8)
+        for k in range(9):
+            better = (cells[k] == EMPTY) & (scores[k] > best)
+            best = np.where(better, scores[k], best)
+            move = np.where(better, np.int8(k), move)
+
+        # Finished boards stay as they are
+        step = marks * active
+        for k in range(9):
+            cells[k] += np.where(move == k, step, 0).astype(np.int8)
+        marks = np.where(active, -marks, marks).astype(np.int8)
+        empties -= active
+
+        outcome = winners(cells)
+        active = (outcome == 0) & (empties > 0)
+
+    boards[:] = cells.T
+    return outcome
+
+
+def simulate(games, x_policy="random", o_policy="random", seed=None, batch=1_000_000):
+    """Play games fresh games in batches; return X / O / DRAW counts."""
+    rng = np.random.default_rng(seed)
+    counts = {"X": 0, "O": 0, "DRAW": 0}
+    left = games
+    while left > 0:
+        n = min(batch, left)
+        boards = np.zeros((n, 9), dtype=np.int8)
+        marks = np.full(n, X, dtype=np.int8)
+        outcome = playout(boards, marks, x_policy, o_policy, rng)
+        x_wins = int((outcome == X).sum())
+        o_wins = int((outcome == O).sum())
+        counts["X"] += x_wins
+        counts["O"] += o_wins
+        counts["DRAW"] += n - x_wins - o_wins
+        left -= n
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Batched tic-tac-toe self-play.")
+    parser.add_argument("--games", type=int, default=1_000_000)
+    parser.add_argument("--x", default="random", choices=sorted(POLICIES), help="policy for X")
+    parser.add_argument("--o", default="random", choices=sorted(POLICIES), help="policy for O")
+    parser.add_argument("--batch", type=int, default=1_000_000, help="boards per batch")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    counts = simulate(args.games, args.x, args.o, args.seed, args.batch)
+    elapsed = time.perf_counter() - started
+    print(json.dumps({
+        "games": args.games,
+        "x": args.x,
+        "o": args.o,
+        "results": counts,
+        "seconds": round(elapsed, 3),
+        "games_per_minute": round(args.games / elapsed * 60) if elapsed else None,
+    }))
+
+
+if __name__ == "__main__":
+    main()
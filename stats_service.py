@@ -0,0 +1,358 @@
+"""Central stats service for a cluster of game servers (see router.py).
+
+Keeps every player's wins / losses / draws, saved to stats.json in its
+working directory, and the load each game server node last reported.
+Nodes send results here instead of writing their own stats.json, and the
+router asks here which node is least loaded.
+
+    python stats_service.py [--port 5600]
+
+Protocol: one JSON object per line over TCP, on long-lived connections.
+
+    {"op": "get", "names": [...]}                       -> {"stats": [{"wins": 0, "losses": 0, "draws": 0}, ...]}
+    {"op": "results", "id": "...", "results": [[winner, loser, draw], ...]}
+                                                        -> {"saved": id}, once stats.json has them
+    {"op": "load", "node": "host:port", "conns": 0, "games": 0}  (no reply)
+    {"op": "nodes"}                                     -> {"nodes": [{"node": "host:port", "conns": 0, "games": 0}, ...]}
+
+StatsClient is the other end, used by server.py and router.py.
+"""
+
+import argparse
+import json
+import logging
+import os
+import queue
+import socket
+import threading
+import itertools
+import time
+import uuid
+from collections import OrderedDict, deque
+
+HOST = "0.0.0.0"
+PORT = 5600
+
+STATS_FILE = "stats.json"
+LOG_FILE = "stats_service.log"
+
+SAVE_INTERVAL = 1.0  # seconds between saves of stats.json, when changed
+NODE_TIMEOUT = 3.0  # nodes that have not reported for this long are left out
+REQUEST_TIMEOUT = 1.0  # seconds a client waits for a reply
+RETRY_AFTER = 5.0  # seconds a client leaves the service alone after a failure
+SAVED_TIMEOUT = 5.0  # seconds results may wait for the save that confirms them
+FLUSH_TIMEOUT = 10.0  # seconds StatsClient.flush() waits by default
+RECENT_BATCHES = 10_000  # result batch ids remembered to drop resent batches
+
+
+def blank():
+    return {"wins": 0, "losses": 0, "draws": 0}
+
+
+# ---------- Service ----------
+
+class StatsService:
+    def __init__(self, path=STATS_FILE):
+        self.path = path
+        self.lock = threading.Lock()
+        self.stats = {}
+        self.nodes = {}  # "host:port" -> (conns, games, time of report)
+        self.version = 0  # bumped by every change to self.stats
+        self.saved_version = 0  # the version stats.json holds
+        self.saved = threading.Condition(self.lock)
+        self.recent = OrderedDict()  # batch id -> version that includes it
+        self.load()
+
+    def load(self):
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    self.stats = json.load(f)
+            except Exception:
+                self.stats = {}
+
+    def save(self):
+        with self.lock:
+            if self.saved_version == self.version:
+                return
+            data = json.dumps(self.stats, indent=2)
+            version = self.version
+        # Write a new file and rename it, so readers (the dashboard) never
+        # see half a file
+        tmp = self.path + ".tmp"
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                f.write(data)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            logging.error("Error saving stats: %s", e)
+            return
+        with self.lock:
+            self.saved_version = max(self.saved_version, version)
+            self.saved.notify_all()
+
+    def saver(self):
+        while True:
+            time.sleep(SAVE_INTERVAL)
+            self.save()
+
+    def handle(self, request):
+        """Reply to one request; None for requests without a reply."""
+        op = request.get("op")
+        if op == "get":
+            with self.lock:
+                return {"stats": [dict(self.stats.setdefault(name, blank())) for name in request["names"]]}
+        if op == "results":
+            return self.record(request["id"], request["results"])
+        if op == "load":
+            with self.lock:
+                self.nodes[request["node"]] = (request["conns"], request["games"], time.monotonic())
+            return None
+        if op == "nodes":
+            now = time.monotonic()
+            with self.lock:
+                nodes = [
+                    {"node": node, "conns": conns, "games": games}
+                    for node, (conns, games, seen) in self.nodes.items()
+                    if now - seen < NODE_TIMEOUT
+                ]
+            return {"nodes": nodes}
+        return {"error": f"unknown op {op!r}"}
+
+    def record(self, batch_id, results):
+        """Add a batch of results and wait until stats.json has them. A
+        batch resent after a lost reply is only counted once."""
+        with self.lock:
+            version = self.recent.get(batch_id)
+            if version is None:
+                for winner, loser, draw in results:
+                    for name in (winner, loser):
+                        self.stats.setdefault(name, blank())
+                    if draw:
+                        self.stats[winner]["draws"] += 1
+                        self.stats[loser]["draws"] += 1
+                    else:
+                        self.stats[winner]["wins"] += 1
+                        self.stats[loser]["losses"] += 1
+                self.version += 1
+                version = self.recent[batch_id] = self.version
+                if len(self.recent) > RECENT_BATCHES:
+                    self.recent.popitem(last=False)
+            if not self.saved.wait_for(lambda: self.saved_version >= version, SAVED_TIMEOUT):
+                return {"error": "results not saved yet"}
+        return {"saved": batch_id}
+
+    def serve_client(self, sock, addr):
+        logging.info("Client connected from %s", addr)
+        with sock, sock.makefile("rb") as lines:
+            for raw in lines:
+                try:
+                    reply = self.handle(json.loads(raw))
+                except (ValueError, KeyError, TypeError) as e:
+                    reply = {"error": f"bad request: {e}"}
+                if reply is not None:
+                    try:
+                        sock.sendall((json.dumps(reply) + "\n").encode("utf-8"))
+                    except OSError:
+                        break
+        logging.info("Client %s disconnected", addr)
+
+
+# ---------- Client ----------
+
+class StatsClient:
+    """Connection from a game server or the router to the stats service.
+
+    get() and nodes() wait for the reply on the caller's thread, at most
+    REQUEST_TIMEOUT, and give up on the service for RETRY_AFTER seconds
+    after a failure; get_later() does the same lookup on a background
+    thread instead. results() and load() return at once: a background
+    thread sends them in batches and sends a batch again until the service
+    confirms it has saved it, so a restarting service never loses a game.
+    The service drops batches it has already counted, unless it was
+    restarted between saving one and confirming it, when the results of
+    that batch are counted twice. flush() waits until every result is
+    confirmed, e.g. before exiting.
+    """
+
+    def __init__(self, addr):
+        self.addr = addr
+        self.lock = threading.Lock()
+        self.sock = None
+        self.lines = None
+        self.down_until = 0.0
+        self.outbox = queue.Queue()
+        self.unsaved = 0  # results handed to results() and not confirmed yet
+        self.unsaved_lock = threading.Lock()
+        self.batch_ids = (f"{uuid.uuid4().hex[:12]}-{n}" for n in itertools.count(1))
+        self.lookups = queue.Queue()
+        threading.Thread(target=self.send_loop, name="stats-client", daemon=True).start()
+        threading.Thread(target=self.lookup_loop, name="stats-lookup", daemon=True).start()
+
+    def connect(self):
+        sock = socket.create_connection(self.addr, timeout=REQUEST_TIMEOUT)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock
+
+    def request(self, message):
+        with self.lock:
+            if time.monotonic() < self.down_until:
+                return None
+            try:
+                if self.sock is None:
+                    self.sock = self.connect()
+                    self.lines = self.sock.makefile("rb")
+                self.sock.sendall((json.dumps(message) + "\n").encode("utf-8"))
+                reply = self.lines.readline()
+                if not reply:
+                    raise ConnectionError("stats service closed the connection")
+                return json.loads(reply)
+            except (OSError, ValueError) as e:
+                logging.error("Stats service %s:%d unavailable: %s", *self.addr, e)
+                if self.sock is not None:
+                    self.sock.close()
+                self.sock = None
+                self.down_until = time.monotonic() + RETRY_AFTER
+                return None
+
+    def get(self, names):
+        """Stats dicts for names; all zeros while the service is unavailable."""
+        reply = self.request({"op": "get", "names": list(names)})
+        if reply is None or "stats" not in reply:
+            return [blank() for _ in names]
+        return reply["stats"]
+
+    def get_later(self, names, callback):
+        """Look names up like get() and call callback(stats) with the result,
+        on the lookup thread, so the caller never waits for the service."""
+        self.lookups.put((list(names), callback))
+
+    def lookup_loop(self):
+        while True:
+            # Everything queued while the last request was out goes in one
+            batch = [self.lookups.get()]
+            while True:
+                try:
+                    batch.append(self.lookups.get_nowait())
+                except queue.Empty:
+                    break
+            found = self.get([name for names, _ in batch for name in names])
+            i = 0
+            for names, callback in batch:
+                callback(found[i:i + len(names)])
+                i += len(names)
+
+    def nodes(self):
+        """Recently reported nodes, or None while the service is unavailable."""
+        reply = self.request({"op": "nodes"})
+        return None if reply is None else reply.get("nodes")
+
+    def results(self, results):
+        results = list(results)
+        with self.unsaved_lock:
+            self.unsaved += len(results)
+        self.outbox.put(("results", results))
+
+    def load(self, node, conns, games):
+        self.outbox.put(("load", {"op": "load", "node": node, "conns": conns, "games": games}))
+
+    def flush(self, timeout=FLUSH_TIMEOUT):
+        """Wait until the service has saved every result; False on timeout."""
+        deadline = time.monotonic() + timeout
+        while True:
+            with self.unsaved_lock:
+                if not self.unsaved:
+                    return True
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(0.05)
+
+    def send_loop(self):
+        sock = None
+        lines = None
+        unsaved = deque()  # (batch id, results) not confirmed yet, oldest first
+        while True:
+            load = None
+            results = []
+            kind, item = self.outbox.get()
+            while True:
+                if kind == "results":
+                    results.extend(item)
+                else:
+                    load = item  # only the latest report matters
+                try:
+                    kind, item = self.outbox.get_nowait()
+                except queue.Empty:
+                    break
+            if results:
+                unsaved.append((next(self.batch_ids), results))
+            # A batch keeps its id when it is sent again, so the service
+            # can tell it already has it
+            data = b"".join(
+                (json.dumps({"op": "results", "id": batch_id, "results": batch}) + "\n").encode("utf-8")
+                for batch_id, batch in unsaved
+            )
+            if load is not None:
+                data += (json.dumps(load) + "\n").encode("utf-8")
+            try:
+                if sock is None:
+                    sock = self.connect()
+                    sock.settimeout(SAVED_TIMEOUT + REQUEST_TIMEOUT)
+                    lines = sock.makefile("rb")
+                sock.sendall(data)
+                while unsaved:
+                    reply = lines.readline()
+                    if not reply:
+                        raise ConnectionError("stats service closed the connection")
+                    batch_id, batch = unsaved[0]
+                    if json.loads(reply).get("saved") != batch_id:
+                        raise ConnectionError("stats service did not save the results")
+                    unsaved.popleft()
+                    with self.unsaved_lock:
+                        self.unsaved -= len(batch)
+            except (OSError, ValueError) as e:
+                logging.error("Could not send to stats service %s:%d: %s", *self.addr, e)
+                if sock is not None:
+                    lines.close()
+                    sock.close()
+                sock = None
+                time.sleep(1)
+                # Come back round even if nothing else gets queued
+                self.outbox.put(("results", []))
+
+
+def parse_addr(text):
+    """"host:port" -> (host, port)."""
+    host, _, port = text.rpartition(":")
+    return host or "127.0.0.1", int(port)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Central stats service for game server nodes.")
+    parser.add_argument("--port", type=int, default=PORT)
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        filename=LOG_FILE,
+        level=logging.INFO,
+        format="%(asctime)s [%(levelname)s] %(message)s",
+    )
+    service = StatsService()
+    threading.Thread(target=service.saver, name="saver", daemon=True).start()
+
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as listener:
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind((HOST, args.port))
+        listener.listen(16)
+        print(f"Stats service listening on {HOST}:{args.port}")
+        logging.info("Stats service starting on %s:%d", HOST, args.port)
+        try:
+            while True:
+                sock, addr = listener.accept()
+                threading.Thread(target=service.serve_client, args=(sock, addr), daemon=True).start()
+        finally:
+            service.save()
+
+
+if __name__ == "__main__":
+    main()
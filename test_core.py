@@ -0,0 +1,235 @@
+"""Tests for the game rules, the flood limits and the stats file.
+
+    python -m pytest -q
+"""
+
+import json
+
+import pytest
+
+import server
+from game_session import (
+    CELL_TAKEN, MOVE_USAGE, NOT_INTEGERS, NOT_YOUR_TURN, OFF_BOARD,
+    GameOver, GameSession, Send, check_winner,
+)
+
+
+def texts(events, mark):
+    return [e.text for e in events if isinstance(e, Send) and e.to == mark]
+
+
+def game_over(events):
+    over = [e for e in events if isinstance(e, GameOver)]
+    return over[0] if over else None
+
+
+def play(session, *moves):
+    """Play moves ("r c") alternately from X; return the events of the last one."""
+    events = []
+    for n, move in enumerate(moves):
+        events = session.handle("XO"[n % 2], f"MOVE {move}")
+    return events
+
+
+# ---------- GameSession ----------
+
+def test_start_opens_the_game_for_x():
+    events = GameSession("alice", "bob").start({"wins": 1, "losses": 2, "draws": 3})
+    assert texts(events, "X")[:2] == ["START X bob", "STATS 1 2 3"]
+    assert texts(events, "O")[0] == "START O alice"
+    assert "TURN X" in texts(events, "O")
+    assert game_over(events) is None
+
+
+def test_win():
+    session = GameSession("alice", "bob")
+    session.start()
+    events = play(session, "0 0", "1 0", "0 1", "1 1", "0 2")
+    assert session.over
+    assert "RESULT WIN" in texts(events, "X")
+    assert "RESULT LOSE" in texts(events, "O")
+    assert game_over(events) == GameOver("alice", "bob", False, "win")
+    assert session.handle("O", "MOVE 2 2") == []
+
+
+def test_draw():
+    session = GameSession("alice", "bob")
+    session.start()
+    events = play(session, "0 0", "0 1", "0 2", "1 1", "1 0", "1 2", "2 1", "2 0", "2 2")
+    assert session.board == "XOXXOOOXX"
+    assert "RESULT DRAW" in texts(events, "X")
+    assert "RESULT DRAW" in texts(events, "O")
+    assert game_over(events) == GameOver("alice", "bob", True, "draw")
+
+
+@pytest.mark.parametrize("reason, call", [
+    ("quit", lambda session: session.handle("O", "QUIT")),
+    ("disconnect", lambda session: session.disconnect("O")),
+])
+def test_leaving_forfeits(reason, call):
+    session = GameSession("alice", "bob")
+    session.start()
+    events = call(session)
+    assert texts(events, "X")[-1] == "RESULT WIN"
+    assert texts(events, "O") == []
+    assert game_over(events) == GameOver("alice", "bob", False, reason)
+    assert session.disconnect("X") == []
+
+
+@pytest.mark.parametrize("mark, arg, reason", [
+    ("O", "1 1", NOT_YOUR_TURN),
+    ("X", "1", MOVE_USAGE),
+    ("X", "a b", NOT_INTEGERS),
+    ("X", "3 0", OFF_BOARD),
+    ("X", "0 0", CELL_TAKEN),
+])
+def test_refused_moves(mark, arg, reason):
+    session = GameSession("alice", "bob")
+    session.start()
+    play(session, "0 0", "1 1")
+    board = session.board
+    events = session.handle(mark, f"MOVE {arg}")
+    assert events == [Send(mark, f"INFO {reason}")]
+    assert session.board == board
+    assert session.current_mark == "X"
+
+
+def test_chat_and_unknown_commands():
+    session = GameSession("alice", "bob")
+    assert session.handle("O", "CHAT hi there") == [
+        Send("X", "MSG bob: hi there"), Send("O", "MSG bob: hi there"),
+    ]
+    assert texts(session.handle("X", "CHAT  "), "X") == ["INFO Usage: CHAT your message"]
+    assert texts(session.handle("X", "DANCE"), "X") == ["INFO Unknown command. Use MOVE or CHAT or QUIT."]
+
+
+def test_snapshot_restore_carries_on():
+    session = GameSession("alice", "bob")
+    session.start()
+    play(session, "0 0", "1 0", "0 1")
+    state = json.loads(json.dumps(session.snapshot()))
+    restored = GameSession.restore(state)
+    assert (restored.board, restored.current_mark) == ("XX-O-----", "O")
+    restored.handle("O", "MOVE 1 1")
+    events = restored.handle("X", "MOVE 0 2")
+    assert game_over(events) == GameOver("alice", "bob", False, "win")
+
+
+# ---------- Flood limits ----------
+
+def test_token_bucket_burst_then_refill():
+    bucket = server.TokenBucket(rate=2.0, burst=3)
+    assert [bucket.take() for _ in range(4)] == [True, True, True, False]
+    # Half a second later there is one token again, never more than burst
+    bucket.stamp -= 0.5
+    assert bucket.take()
+    assert not bucket.take()
+    bucket.stamp -= 60
+    assert [bucket.take() for _ in range(4)] == [True, True, True, False]
+
+
+def test_token_bucket_warns_once_per_burst():
+    bucket = server.TokenBucket(rate=0.0, burst=1)
+    assert bucket.take()
+    assert not bucket.take()
+    assert bucket.warning("slow down") == "slow down"
+    assert bucket.warning("slow down") is None
+    bucket.tokens = 1
+    assert bucket.take()
+    assert bucket.warning("slow down") == "slow down"
+
+
+def test_limits_always_answer_a_dropped_move():
+    limits = server.Limits()
+    limits.commands.rate = 0
+    for _ in range(server.COMMAND_BURST):
+        assert limits.check("MOVE", "1 1") == (True, None)
+    throttled = (False, f"INFO {server.MOVE_THROTTLED}")
+    assert limits.check("MOVE", "1 1") == throttled
+    assert limits.check("move", "1 1") == throttled
+    assert limits.check("QUIT", "") == (False, "INFO Too many commands, slow down.")
+    assert limits.check("QUIT", "") == (False, None)
+
+
+def test_limits_on_chat():
+    limits = server.Limits()
+    limits.chat.rate = 0
+    allowed, reply = limits.check("CHAT", "x" * (server.MAX_CHAT_LEN + 1))
+    assert not allowed and "too long" in reply
+    for _ in range(server.CHAT_BURST):
+        assert limits.check("CHAT", "hi") == (True, None)
+    assert limits.check("CHAT", "hi") == (False, "INFO Chat rate limit reached, message dropped.")
+    assert limits.check("CHAT", "hi") == (False, None)
+    assert limits.check("MOVE", "1 1") == (True, None)
+
+
+# ---------- Stats ----------
+
+def test_add_results():
+    table = {"alice": {"wins": 1, "losses": 0, "draws": 0}}
+    server.add_results(table, [("alice", "bob", False), ("bob", "alice", True)])
+    assert table == {
+        "alice": {"wins": 2, "losses": 0, "draws": 1},
+        "bob": {"wins": 0, "losses": 1, "draws": 1},
+    }
+
+
+@pytest.fixture
+def stats_file(tmp_path, monkeypatch):
+    path = tmp_path / "stats.json"
+    monkeypatch.setattr(server, "STATS_FILE", str(path))
+    monkeypatch.setattr(server, "STATS_LOCK_FILE", str(tmp_path / "stats.json.lock"))
+    monkeypatch.setattr(server, "stats", {})
+    monkeypatch.setattr(server, "stats_unsaved", [])
+    return path
+
+
+def test_save_stats_merges_with_the_file(stats_file):
+    # Another process saved carol's game since we last read the file
+    stats_file.write_text(json.dumps({
+        "alice": {"wins": 1, "losses": 0, "draws": 0},
+        "carol": {"wins": 0, "losses": 1, "draws": 0},
+    }))
+    server.stats = {"alice": {"wins": 1, "losses": 0, "draws": 0}}
+    server.add_results(server.stats, [("alice", "bob", False)])
+    server.stats_unsaved = [("alice", "bob", False)]
+
+    server.save_stats()
+
+    expected = {
+        "alice": {"wins": 2, "losses": 0, "draws": 0},
+        "bob": {"wins": 0, "losses": 1, "draws": 0},
+        "carol": {"wins": 0, "losses": 1, "draws": 0},
+    }
+    assert json.loads(stats_file.read_text()) == expected
+    assert server.stats == expected
+    assert server.stats_unsaved == []
+
+
+def test_save_stats_without_a_file_writes_memory(stats_file):
+    server.add_results(server.stats, [("alice", "bob", True)])
+    server.stats_unsaved = [("alice", "bob", True)]
+    server.save_stats()
+    assert json.loads(stats_file.read_text()) == {
+        "alice": {"wins": 0, "losses": 0, "draws": 1},
+        "bob": {"wins": 0, "losses": 0, "draws": 1},
+    }
+
+
+# ---------- Simulator ----------
+
+def test_simulator_agrees_with_check_winner():
+    simulator = pytest.importorskip("simulator")
+    np = simulator.np
+    rng = np.random.default_rng(7)
+    for x_policy, o_policy in (("random", "random"), ("greedy", "random")):
+        boards = np.zeros((2000, 9), dtype=np.int8)
+        marks = np.full(2000, simulator.X, dtype=np.int8)
+        outcome = simulator.playout(boards, marks, x_policy, o_policy, rng)
+        for row, result in zip(boards, outcome):
+            board = simulator.decode(row)
+            winner = check_winner(board)
+            assert winner == {1: "X", -1: "O", 0: "DRAW"}[int(result)]
+            # X moves first, and the winner made the last move
+            extra_x = board.count("X") - board.count("O")
+            assert extra_x == {"X": 1, "O": 0, "DRAW": 1}[winner]
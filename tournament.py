@@ -0,0 +1,491 @@
+"""Tournament runner: round-robin, Swiss and knockout events.
+
+Entrants are registered with a bot strategy. Games between two in-process
+bots never touch a socket: the bots are handed the board directly and
+check_winner() from game_session.py decides the game, so large brackets run on a
+process pool in seconds. Entrants registered as remote play every game
+through a running server instead, over one multiplexed connection.
+
+Finished games are fed into the same wins / losses / draws records the
+server keeps (stats.json), one save per round. A server running in the
+same directory can keep using the file: each save adds the new results to
+what is on disk. For a cluster, --stats sends them to its stats service.
+
+    python tournament.py swiss --entrants 10000 --bot mixed --workers 8
+    python tournament.py knockout --players players.txt --server localhost:5500
+
+A players file has one "name [bot] [remote]" per line.
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import sys
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import server
+from async_client import MuxConnection, play_game
+from stats_service import StatsClient, parse_addr
+from game_session import LINES, check_winner
+
+# ---------- Bots ----------
+#
+# A bot gets the board (9 chars or list of 'X' / 'O' / '-') and a
+# random.Random, and returns the cell index to play. Its own mark follows
+# from the board: X moves whenever both marks have been played equally often.
+
+
+def whose_move(board):
+    return "X" if list(board).count("X") == list(board).count("O") else "O"
+
+
+def random_bot(board, rng):
+    empty = [i for i, ch in enumerate(board) if ch == "-"]
+    return rng.choice(empty)
+
+
+def greedy_bot(board, rng):
+    # Win if possible, else block, else centre, corners, edges
+    me = whose_move(board)
+    opp = "O" if me == "X" else "X"
+    for mark in (me, opp):
+        for line in LINES:
+            cells = [board[i] for i in line]
+            if cells.count(mark) == 2 and cells.count("-") == 1:
+                return line[cells.index("-")]
+    for group in ((4,), (0, 2, 6, 8), (1, 3, 5, 7)):
+        empty = [i for i in group if board[i] == "-"]
+        if empty:
+            return rng.choice(empty)
+    return random_bot(board, rng)
+
+
+BOTS = {
+    "random": random_bot,
+    "greedy": greedy_bot,
+}
+
+
+# One registered player. bot is a key of BOTS; remote entrants play through
+# the server even when their opponent is an in-process bot.
+Entrant = namedtuple("Entrant", "name bot remote")
+
+# One game to play: names, bot keys and a seed so the game is reproducible
+GameSpec = namedtuple("GameSpec", "x_name x_bot o_name o_bot seed remote")
+
+
+# ---------- Playing games ----------
+
+# Play one game between two in-process bots, return "X", "O" or "DRAW"
+def play_local(x_bot, o_bot, seed):
+    rng = random.Random(seed)
+    bots = {"X": BOTS[x_bot], "O": BOTS[o_bot]}
+    board = ["-"] * 9
+    mark = "X"
+    while True:
+        idx = bots[mark](board, rng)
+        if board[idx] != "-":
+            # A broken bot forfeits the game
+            return "O" if mark == "X" else "X"
+        board[idx] = mark
+        winner = check_winner(board)
+        if winner:
+            return winner
+        mark = "O" if mark == "X" else "X"
+
+
+# Worker entry point: play a chunk of local games in a pool process
+def play_local_chunk(specs):
+    return [play_local(g.x_bot, g.o_bot, g.seed) for g in specs]
+
+
+# Play games through a running server over mux connections, as many games
+# on each as the server seats per connection
+async def play_remote_games(specs, host, port, tag):
+    per_conn = server.MAX_SEATS_PER_CONN // 2
+    muxes = []
+
+    async def one(n, g):
+        mux = muxes[n // per_conn]
+        room = f"{tag}-{n}"
+        x = mux.game(g.x_name, room)
+        o = mux.game(g.o_name, room)
+        x_rng = random.Random(g.seed)
+        o_rng = random.Random(g.seed + 1)
+
+        def chooser(bot, rng):
+            return lambda board: divmod(BOTS[bot](board, rng), 3)
+
+        # X joins the room first, so the server seats it as X
+        await x.new_game()
+        outcome, _ = await asyncio.gather(
+            play_game(x, chooser(g.x_bot, x_rng)),
+            play_game(o, chooser(g.o_bot, o_rng)),
+        )
+        return {"WIN": "X", "LOSE": "O", "DRAW": "DRAW"}.get(outcome)
+
+    try:
+        for _ in range(0, len(specs), per_conn):
+            mux = MuxConnection(host, port)
+            await mux.connect()
+            muxes.append(mux)
+        return await asyncio.gather(*(one(n, g) for n, g in enumerate(specs)))
+    finally:
+        for mux in muxes:
+            await mux.close()
+
+
+class Runner:
+    """Plays batches of games, locally on a process pool or via the server."""
+
+    def __init__(self, workers=None, server_addr=None, record=True):
+        self.workers = workers if workers is not None else (os.cpu_count() or 1)
+        self.server_addr = server_addr
+        self.record = record
+        self.pool = None
+        self.batches = 0
+        self.games_played = 0
+
+    def __enter__(self):
+        if self.workers > 1:
+            self.pool = ProcessPoolExecutor(max_workers=self.workers)
+        return self
+
+    def __exit__(self, *exc):
+        if self.pool is not None:
+            self.pool.shutdown()
+
+    def play(self, specs):
+        """Play every GameSpec and return the outcomes in the same order."""
+        outcomes = [None] * len(specs)
+        local = [i for i, g in enumerate(specs) if not g.remote]
+        remote = [i for i, g in enumerate(specs) if g.remote]
+
+        if local:
+            local_specs = [specs[i] for i in local]
+            if self.pool is None:
+                results = play_local_chunk(local_specs)
+            else:
+                # Few big chunks: a game is far cheaper than pickling it
+                size = max(1, math.ceil(len(local_specs) / (self.workers * 4)))
+                chunks = [local_specs[i:i + size] for i in range(0, len(local_specs), size)]
+                results = [r for chunk in self.pool.map(play_local_chunk, chunks) for r in chunk]
+            for i, outcome in zip(local, results):
+                outcomes[i] = outcome
+
+        if remote:
+            if self.server_addr is None:
+                raise ValueError("remote entrants need a server address")
+            host, port = self.server_addr
+            self.batches += 1
+            tag = f"t{os.getpid()}-{self.batches}"
+            results = asyncio.run(play_remote_games([specs[i] for i in remote], host, port, tag))
+            for i, outcome in zip(remote, results):
+                outcomes[i] = outcome
+
+        self.games_played += len(specs)
+        if self.record:
+            # The server already recorded the games it hosted itself
+            server.update_stats_many(
+                stats_row(g, outcome)
+                for g, outcome in zip(specs, outcomes)
+                if outcome and not g.remote
+            )
+        return outcomes
+
+
+# Turn one game outcome into an update_stats (winner, loser, draw) row
+def stats_row(g, outcome):
+    if outcome == "O":
+        return g.o_name, g.x_name, False
+    return g.x_name, g.o_name, outcome == "DRAW"
+
+
+# ---------- Formats ----------
+
+class Tournament:
+    """Base class: entrants, points table and game scheduling helpers."""
+
+    def __init__(self, entrants, runner, games_per_match=2, seed=0):
+        if len(set(e.name for e in entrants)) != len(entrants):
+            raise ValueError("entrant names must be unique")
+        self.entrants = list(entrants)
+        self.runner = runner
+        self.games_per_match = games_per_match
+        self.rng = random.Random(seed)
+        self.points = {e.name: 0.0 for e in entrants}
+        self.matches = []  # (name_a, name_b, points_a, points_b)
+
+    def match_games(self, a, b, count=None):
+        """Games of one match, alternating who plays X."""
+        specs = []
+        for n in range(count or self.games_per_match):
+            x, o = (a, b) if n % 2 == 0 else (b, a)
+            specs.append(GameSpec(x.name, x.bot, o.name, o.bot,
+                                  self.rng.getrandbits(32), x.remote or o.remote))
+        return specs
+
+    def play_matches(self, pairs):
+        """Play a round of matches and return (points_a, points_b) per pair."""
+        specs = []
+        for a, b in pairs:
+            specs.extend(self.match_games(a, b))
+        outcomes = self.runner.play(specs)
+
+        scores = []
+        n = self.games_per_match
+        for k, (a, b) in enumerate(pairs):
+            pa = pb = 0.0
+            for g, outcome in zip(specs[k * n:(k + 1) * n], outcomes[k * n:(k + 1) * n]):
+                if outcome == "DRAW":
+                    pa += 0.5
+                    pb += 0.5
+                elif outcome in ("X", "O"):
+                    winner = g.x_name if outcome == "X" else g.o_name
+                    if winner == a.name:
+                        pa += 1
+                    else:
+                        pb += 1
+            self.points[a.name] += pa
+            self.points[b.name] += pb
+            self.matches.append((a.name, b.name, pa, pb))
+            scores.append((pa, pb))
+        return scores
+
+    def standings(self):
+        order = {e.name: i for i, e in enumerate(self.entrants)}
+        return sorted(self.points.items(), key=lambda kv: (-kv[1], order[kv[0]]))
+
+
+class RoundRobin(Tournament):
+    """Everybody plays everybody once, scheduled with the circle method."""
+
+    def run(self):
+        players = list(self.entrants)
+        if len(players) % 2:
+            players.append(None)
+        n = len(players)
+        for _ in range(n - 1):
+            pairs = [
+                (players[i], players[n - 1 - i])
+                for i in range(n // 2)
+                if players[i] is not None and players[n - 1 - i] is not None
+            ]
+            self.play_matches(pairs)
+            players = [players[0], players[-1]] + players[1:-1]
+        return self.standings()
+
+
+class Swiss(Tournament):
+    """Fixed number of rounds, pairing players on equal points."""
+
+    def __init__(self, entrants, runner, rounds=None, **kwargs):
+        super().__init__(entrants, runner, **kwargs)
+        self.rounds = rounds or max(1, math.ceil(math.log2(max(2, len(entrants)))))
+        self.met = set()
+        self.byes = set()
+
+    def pair_round(self):
+        order = {e.name: i for i, e in enumerate(self.entrants)}
+        pool = sorted(self.entrants, key=lambda e: (-self.points[e.name], order[e.name]))
+
+        # Odd field: lowest ranked player without a bye sits out for a point
+        if len(pool) % 2:
+            for e in reversed(pool):
+                if e.name not in self.byes:
+                    break
+            pool.remove(e)
+            self.byes.add(e.name)
+            self.points[e.name] += self.games_per_match / 2
+
+        # Pair down the table, skipping rematches within a small window
+        pairs = []
+        while pool:
+            a = pool.pop(0)
+            for k, b in enumerate(pool[:8]):
+                if (a.name, b.name) not in self.met:
+                    break
+            else:
+                k = 0
+            b = pool.pop(k)
+            self.met.add((a.name, b.name))
+            self.met.add((b.name, a.name))
+            pairs.append((a, b))
+        return pairs
+
+    def run(self):
+        for _ in range(self.rounds):
+            self.play_matches(self.pair_round())
+        return self.standings()
+
+
+class Knockout(Tournament):
+    """Single elimination. Byes fill the first round up to a power of two.
+
+    A tied match goes to sudden-death games; if those are all drawn as well,
+    the entrant registered first goes through.
+    """
+
+    def __init__(self, entrants, runner, sudden_death=4, **kwargs):
+        super().__init__(entrants, runner, **kwargs)
+        self.sudden_death = sudden_death
+        self.eliminated = []  # names, in order of elimination
+
+    def run(self):
+        alive = list(self.entrants)
+        size = 1
+        while size < len(alive):
+            size *= 2
+        byes = size - len(alive)
+        # Top seeds get the byes
+        advancing, alive = alive[:byes], alive[byes:]
+
+        while len(alive) + len(advancing) > 1:
+            pairs = [(alive[i], alive[len(alive) - 1 - i]) for i in range(len(alive) // 2)]
+            scores = self.play_matches(pairs)
+
+            ties = [k for k, (pa, pb) in enumerate(scores) if pa == pb]
+            winners = {}
+            for d in range(self.sudden_death):
+                if not ties:
+                    break
+                # Sudden-death games keep alternating who plays X
+                tie_pairs = [pairs[k] if d % 2 == 0 else pairs[k][::-1] for k in ties]
+                specs = [self.match_games(a, b, 1)[0] for a, b in tie_pairs]
+                outcomes = self.runner.play(specs)
+                still = []
+                for k, g, outcome in zip(ties, specs, outcomes):
+                    if outcome == "X":
+                        winners[k] = g.x_name
+                    elif outcome == "O":
+                        winners[k] = g.o_name
+                    else:
+                        still.append(k)
+                ties = still
+
+            next_round = list(advancing)
+            for k, ((a, b), (pa, pb)) in enumerate(zip(pairs, scores)):
+                if k in winners:
+                    win = a if winners[k] == a.name else b
+                elif pa != pb:
+                    win = a if pa > pb else b
+                else:
+                    win = a  # a is always the higher seed
+                lose = b if win is a else a
+                self.eliminated.append(lose.name)
+                next_round.append(win)
+            advancing, alive = [], next_round
+        self.champion = (alive + advancing)[0].name
+        return self.standings()
+
+    def standings(self):
+        # Champion first, then in reverse order of elimination
+        names = [self.champion] + self.eliminated[::-1]
+        return [(name, self.points[name]) for name in names]
+
+
+FORMATS = {
+    "round-robin": RoundRobin,
+    "swiss": Swiss,
+    "knockout": Knockout,
+}
+
+
+# ---------- Command line ----------
+
+def load_players(path):
+    entrants = []
+    with open(path, "r", encoding="utf-8") as f:
+        for raw in f:
+            tokens = raw.split()
+            if not tokens or tokens[0].startswith("#"):
+                continue
+            bot = tokens[1] if len(tokens) > 1 else "random"
+            if bot not in BOTS:
+                raise ValueError(f"unknown bot {bot!r} for {tokens[0]}")
+            remote = len(tokens) > 2 and tokens[2] == "remote"
+            entrants.append(Entrant(tokens[0], bot, remote))
+    return entrants
+
+
+def make_entrants(count, bot):
+    names = sorted(BOTS)
+    return [
+        Entrant(f"{bot if bot != 'mixed' else names[i % len(names)]}-{i}",
+                bot if bot != "mixed" else names[i % len(names)], False)
+        for i in range(count)
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a tic-tac-toe tournament.")
+    parser.add_argument("format", choices=sorted(FORMATS))
+    who = parser.add_mutually_exclusive_group(required=True)
+    who.add_argument("--players", help="file with 'name [bot] [remote]' lines")
+    who.add_argument("--entrants", type=int, help="number of generated bot entrants")
+    parser.add_argument("--bot", default="mixed", choices=sorted(BOTS) + ["mixed"],
+                        help="bot for generated entrants")
+    parser.add_argument("--games", type=int, default=2, help="games per match")
+    parser.add_argument("--rounds", type=int, help="Swiss rounds (default log2 of entrants)")
+    parser.add_argument("--workers", type=int, default=None, help="pool processes (1 = no pool)")
+    parser.add_argument("--server", help="host:port for remote entrants")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--top", type=int, default=10, help="standings lines to print")
+    parser.add_argument("--no-stats", action="store_true", help="do not update stats.json")
+    parser.add_argument("--stats", metavar="HOST:PORT",
+                        help="record results with this stats service instead of stats.json")
+    args = parser.parse_args()
+
+    try:
+        if args.players:
+            entrants = load_players(args.players)
+        else:
+            entrants = make_entrants(args.entrants, args.bot)
+    except (OSError, ValueError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(2)
+    if len(entrants) < 2:
+        print("Error: need at least two entrants", file=sys.stderr)
+        sys.exit(2)
+
+    server_addr = None
+    if args.server:
+        host, _, port = args.server.rpartition(":")
+        server_addr = (host, int(port))
+
+    if args.stats and not args.no_stats:
+        server.stats_client = StatsClient(parse_addr(args.stats))
+    elif not args.no_stats:
+        server.load_stats()
+
+    kwargs = {"games_per_match": args.games, "seed": args.seed}
+    if args.format == "swiss":
+        kwargs["rounds"] = args.rounds
+
+    started = time.perf_counter()
+    with Runner(args.workers, server_addr, record=not args.no_stats) as runner:
+        event = FORMATS[args.format](entrants, runner, **kwargs)
+        table = event.run()
+    server.flush_stats()
+    if server.stats_client is not None and not server.stats_client.flush():
+        print("Warning: the stats service did not confirm every result", file=sys.stderr)
+    elapsed = time.perf_counter() - started
+
+    for rank, (name, points) in enumerate(table[:args.top], 1):
+        print(f"{rank:>5}. {name:<24} {points:g}")
+    print(json.dumps({
+        "format": args.format,
+        "entrants": len(entrants),
+        "matches": len(event.matches),
+        "games": runner.games_played,
+        "seconds": round(elapsed, 3),
+    }))
+
+
+if __name__ == "__main__":
+    main()